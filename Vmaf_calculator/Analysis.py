@@ -0,0 +1,298 @@
+import config
+import os
+from FFmpeg import HD_MODEL_NAME, HD_NEG_MODEL_NAME, HD_PHONE_MODEL_NAME, _4K_MODEL_NAME
+from FFmpeg import PSNR_FEATURE_NAME, SSIM_FEATURE_NAME, MS_SSIM_FEATURE_NAME
+from Vmaf import vmaf, vmafLadder, SYNC_MARGIN
+from Results import ResultsStore
+from VmafLog import readVmafLog, getPooled, mergeVmafLogs
+from JobQueue import JOB_DONE
+
+
+MODEL_METRICS = {'HD': [HD_MODEL_NAME, HD_NEG_MODEL_NAME, HD_PHONE_MODEL_NAME],
+                 '4K': [_4K_MODEL_NAME]}
+FEATURE_METRICS = [PSNR_FEATURE_NAME, SSIM_FEATURE_NAME, MS_SSIM_FEATURE_NAME]
+
+
+class AnalysisResult:
+    '''
+    Scores of a MAIN video against a REF video, as computed by analyze().
+        - distorted, reference, model: MAIN and REF video paths and the vmaf model
+        - offset: offset (seconds) between MAIN and REF. syncPsnr: psnr of the sync lookup (None for manual offsets)
+        - frames: {metric: float64 array} per frame values of the libvmaf log: vmaf models, psnr_y, float_ssim...
+        - pooled: {metric: {'mean', 'harmonic_mean', 'min', 'max', 'p1', 'p5', 'p50', 'p95'}} of each array in frames
+        - ssimStandalone: per frame values of the standalone SSIM pass, if it was run
+        - vmafPath, cambiHeatmapPath: output files
+        - cached: True if the VMAF scores were read from the results store instead of computed
+    Sync offsets and per frame scores are saved in a local store (AnalysisResult.store, see Results.ResultsStore)
+    and reused by later analyses of the same content with the same options. Set AnalysisResult.store to None to disable it.
+    '''
+    store = ResultsStore(os.path.join(config.cache_dir, 'results')) if config.results_store else None
+
+    def __init__(self, distorted, reference, model='HD'):
+        self.distorted = distorted
+        self.reference = reference
+        self.model = model
+        self.offset = 0
+        self.syncPsnr = None
+        self.frames = {}
+        self.pooled = {}
+        self.ssimStandalone = None
+        self.vmafPath = None
+        self.cambiHeatmapPath = None
+        self.cached = False
+
+    def _setFrames(self, frames):
+        self.frames = frames
+        self.pooled = {name: getPooled(values) for name, values in self.frames.items()
+                       if name != 'frameNum'}
+
+    def read(self, myVmaf):
+        """It reads the libvmaf log written by myVmaf.getVmaf()"""
+        self.vmafPath = myVmaf.ffmpegQos.vmafpath
+        if myVmaf.cambi_heatmap:
+            self.cambiHeatmapPath = myVmaf.ffmpegQos.vmaf_cambi_heatmap_path
+        self._setFrames(readVmafLog(self.vmafPath, myVmaf.output_fmt,
+                                    MODEL_METRICS[self.model] + FEATURE_METRICS))
+
+    def load(self, myVmaf):
+        """
+        It loads the scores of the VMAF graph set by myVmaf.setVmafGraph() from the store. It returns False if they
+        are not there.
+        """
+        if AnalysisResult.store == None:
+            return False
+        entry = AnalysisResult.store.getVmaf(_getVmafKey(myVmaf))
+        if entry == None:
+            return False
+        """ the outputs of the run that computed them are reported only while they are not overwritten """
+        self.vmafPath = entry['vmaf_path']
+        self.cambiHeatmapPath = entry['cambi_heatmap_path']
+        self.cached = True
+        self._setFrames(entry['frames'])
+        print("VMAF scores found in the results store:", self.distorted, flush=True)
+        return True
+
+    def save(self, myVmaf, key=None):
+        """It saves the scores read from the log of myVmaf in the store. key: default, the one of its VMAF graph"""
+        if AnalysisResult.store == None:
+            return
+        if key == None:
+            key = _getVmafKey(myVmaf)
+        AnalysisResult.store.putVmaf(key, self.distorted, self.reference, self.model,
+                                     myVmaf.ffmpegQos.getGraph(), self.frames, self.vmafPath, self.cambiHeatmapPath)
+
+    def getSsim(self):
+        """pooled SSIM: the standalone pass one if it was run, otherwise the libvmaf one"""
+        if self.ssimStandalone is not None:
+            return getPooled(self.ssimStandalone)['mean']
+        return self.pooled[SSIM_FEATURE_NAME]['mean']
+
+    def getSummary(self):
+        """dict with the pooled (mean) scores, as printed by Vmaf_calculator.py"""
+        summary = {'distorted': self.distorted, 'offset': self.offset, 'psnr': self.syncPsnr}
+        if not self.frames:
+            return summary
+        summary['ssim'] = self.getSsim()
+        summary['ms_ssim'] = self.pooled[MS_SSIM_FEATURE_NAME]['mean']
+        if self.model == 'HD':
+            summary['vmaf_hd'] = self.pooled[HD_MODEL_NAME]['mean']
+            summary['vmaf_neg'] = self.pooled[HD_NEG_MODEL_NAME]['mean']
+            summary['vmaf_phone'] = self.pooled[HD_PHONE_MODEL_NAME]['mean']
+        if self.model == '4K':
+            summary['vmaf_4k'] = self.pooled[_4K_MODEL_NAME]['mean']
+        summary['vmaf_path'] = self.vmafPath
+        if self.cambiHeatmapPath != None:
+            summary['cambi_heatmap_path'] = self.cambiHeatmapPath
+        summary['cached'] = self.cached
+        return summary
+
+
+def _getVmafKey(myVmaf):
+    """store key of the VMAF run of myVmaf: its inputs and filter graph (and segments, if it is split)"""
+    ffmpegQos = myVmaf.ffmpegQos
+    parts = [ffmpegQos.getGraph()]
+    if myVmaf.isSegmented():
+        parts.append(myVmaf.segments)
+    return AnalysisResult.store.getKey('vmaf', [ffmpegQos.main.videoSrc, ffmpegQos.ref.videoSrc], *parts)
+
+
+def _sync(myVmaf, result, syncWindow, syncStart, reverse, syncSearch, syncMargin):
+    """
+    If syncWindow > 0 the offset is computed automatically (or read from the results store), otherwise syncStart is used as offset
+    """
+    if syncWindow > 0:
+        store = AnalysisResult.store
+        key = None
+        if store != None:
+            key = store.getKey('sync', [myVmaf.main.videoSrc, myVmaf.ref.videoSrc],
+                               syncWindow, syncStart, reverse, syncSearch, syncMargin,
+                               myVmaf.manual_fps, myVmaf.denoise, myVmaf.brightness, myVmaf.main.probe_depth)
+            stored = store.getSync(key)
+            if stored != None:
+                result.offset, result.syncPsnr = stored
+                myVmaf.offset = result.offset
+                print("Sync offset found in the results store:", result.offset, flush=True)
+                return
+        result.offset, result.syncPsnr = myVmaf.syncOffset(
+            syncWindow, syncStart, reverse, syncSearch, syncMargin)
+        if store != None:
+            store.putSync(key, result.distorted, result.reference, result.offset, result.syncPsnr)
+    else:
+        result.offset = syncStart
+        if reverse:
+            myVmaf.offset = -syncStart
+        else:
+            myVmaf.offset = syncStart
+
+
+def analyze(mainSrc, refSrc, output_fmt='json', syncWindow=0, syncStart=0, reverse=False, syncSearch='auto', syncMargin=SYNC_MARGIN, ssimStandalone=False, ssimWorkers=0, syncOnly=False, **vmafArgs):
+    """
+    In-process analysis of MAIN vs REF: sync, standalone SSIM (if ssimStandalone) and VMAF, with PSNR, SSIM and MS-SSIM
+    computed by libvmaf in the same pass. With syncOnly (and syncWindow > 0) only the offset is computed.
+    vmafArgs: other keyword arguments of vmaf() (model, subsample, threads, manual_fps...)
+    It returns an AnalysisResult.
+    """
+    myVmaf = vmaf(mainSrc, refSrc, output_fmt, **vmafArgs)
+    result = AnalysisResult(mainSrc, refSrc, myVmaf.model)
+    _sync(myVmaf, result, syncWindow, syncStart, reverse, syncSearch, syncMargin)
+    if syncOnly and syncWindow > 0:
+        return result
+
+    if ssimStandalone:
+        result.ssimStandalone = myVmaf.getSsim(ssimWorkers)
+    myVmaf.setVmafGraph()
+    if not result.load(myVmaf):
+        myVmaf.runVmaf()
+        result.read(myVmaf)
+        result.save(myVmaf)
+    return result
+
+
+def analyzeLadder(mainSrcs, refSrc, output_fmt='json', syncWindow=0, syncStart=0, reverse=False, syncSearch='auto', syncMargin=SYNC_MARGIN, ssimStandalone=False, ssimWorkers=0, syncOnly=False, **vmafArgs):
+    """
+    As analyze(), for several MAIN videos: each one is synced on its own and then VMAF of all of them is computed in
+    a single ffmpeg run that decodes REF once (see vmafLadder). Only the ones not found in the results store are computed.
+    It returns a list of AnalysisResult, in mainSrcs order.
+    """
+    myLadder = vmafLadder(mainSrcs, refSrc, output_fmt, **vmafArgs)
+    results = []
+    for rung in myLadder.rungs:
+        result = AnalysisResult(rung.mainSrc, refSrc, rung.model)
+        _sync(rung, result, syncWindow, syncStart, reverse, syncSearch, syncMargin)
+        if ssimStandalone and not (syncOnly and syncWindow > 0):
+            result.ssimStandalone = rung.getSsim(ssimWorkers)
+        results.append(result)
+    if syncOnly and syncWindow > 0:
+        return results
+
+    """ rungs are looked up with the graph of their own MAIN vs REF run: the same scores as in the ladder run """
+    missing = []
+    for rung, result in zip(myLadder.rungs, results):
+        rung.setVmafGraph()
+        if not result.load(rung):
+            missing.append((rung, result))
+    if not missing:
+        return results
+
+    storeKeys = [None] * len(missing)
+    if AnalysisResult.store != None:
+        storeKeys = [_getVmafKey(rung) for rung, result in missing]
+    myLadder.getVmaf([rung for rung, result in missing])
+    for (rung, result), key in zip(missing, storeKeys):
+        result.read(rung)
+        result.save(rung, key)
+    return results
+
+
+def runJob(job, cancel=None, threads=None):
+    """
+    It runs a job of a JobQueue (see JobQueue.runWorker) and returns its result:
+        - 'analyze': analyze() of args 'main' vs 'ref' with keyword arguments 'kwargs'. Result: its summary (getSummary)
+        - 'segment': VMAF run of the segment 'index' of 'segments' (see vmaf.runSegment) of 'main' vs 'ref' aligned by
+          'offset', with 'output_fmt' and vmaf() keyword arguments 'kwargs'. Result: [partPath, start, end, shift] of its log
+    cancel: CancelToken of the job. threads: threads of the worker, instead of the ones of the coordinator
+    """
+    args = job['args']
+    kwargs = dict(args['kwargs'], cancel=cancel)
+    if threads != None:
+        kwargs['threads'] = threads
+    if job['kind'] == 'analyze':
+        return analyze(args['main'], args['ref'], **kwargs).getSummary()
+    if job['kind'] == 'segment':
+        myVmaf = vmaf(args['main'], args['ref'], args['output_fmt'], **kwargs)
+        myVmaf.offset = args['offset']
+        """ each attempt writes its own log, so a run taken from a stalled worker never overwrites it """
+        logBase = f'{os.path.splitext(myVmaf.mainSrc)[0]}.job{job["id"]}-{job["attempts"]}'
+        return myVmaf.runSegment(args['segments'], args['index'], logBase)
+    raise ValueError(f'Unknown job kind: {job["kind"]}')
+
+
+def _removeParts(jobs):
+    for job in jobs:
+        if job['kind'] == 'segment' and job['result'] != None and os.path.isfile(job['result'][0]):
+            os.remove(job['result'][0])
+
+
+def analyzeQueued(queue, mainSrcs, refSrc, output_fmt='json', syncWindow=0, syncStart=0, reverse=False, syncSearch='auto', syncMargin=SYNC_MARGIN, ssimStandalone=False, ssimWorkers=0, syncOnly=False, segments=1, cancel=None, **vmafArgs):
+    """
+    As analyze() for each of mainSrcs, computed by the workers of queue (see JobQueue.runWorker), on any host.
+    Each MAIN is a job. With segments > 1, this process syncs each MAIN instead and submits one job per segment of
+    its VMAF run (see vmaf._getSegments), so the segments of a long video are computed by several workers at once.
+    Their logs are merged here and saved in the results store.
+    vmafArgs: keyword arguments of vmaf(), json serializable (i.e., no progress callback)
+    It returns the summary (AnalysisResult.getSummary) of each MAIN, in mainSrcs order. Failed ones have 'error'.
+    """
+    analyzeArgs = dict(output_fmt=output_fmt, syncWindow=syncWindow, syncStart=syncStart, reverse=reverse,
+                       syncSearch=syncSearch, syncMargin=syncMargin, ssimStandalone=ssimStandalone,
+                       ssimWorkers=ssimWorkers, syncOnly=syncOnly, **vmafArgs)
+    segmented = segments > 1 and not vmafArgs.get('cambi_heatmap')
+    summaries = {}
+    """ [main, job ids, vmaf, AnalysisResult] of the submitted MAIN videos """
+    pending = []
+    for mainSrc in mainSrcs:
+        if not segmented:
+            jobId = queue.submit('analyze', {'main': mainSrc, 'ref': refSrc, 'kwargs': analyzeArgs})
+            pending.append([mainSrc, [jobId], None, None])
+            continue
+        try:
+            myVmaf = vmaf(mainSrc, refSrc, output_fmt, cancel=cancel, segments=segments, **vmafArgs)
+            result = AnalysisResult(mainSrc, refSrc, myVmaf.model)
+            _sync(myVmaf, result, syncWindow, syncStart, reverse, syncSearch, syncMargin)
+            if syncOnly and syncWindow > 0:
+                summaries[mainSrc] = result.getSummary()
+                continue
+            if ssimStandalone:
+                result.ssimStandalone = myVmaf.getSsim(ssimWorkers)
+            myVmaf.setVmafGraph()
+            if result.load(myVmaf):
+                summaries[mainSrc] = result.getSummary()
+                continue
+            vmafSegments = myVmaf._getSegments()
+        except Exception as e:
+            summaries[mainSrc] = {'distorted': mainSrc, 'error': str(e)}
+            continue
+        segmentArgs = {'main': mainSrc, 'ref': refSrc, 'output_fmt': output_fmt, 'kwargs': vmafArgs,
+                       'offset': myVmaf.offset, 'segments': vmafSegments}
+        jobIds = [queue.submit('segment', dict(segmentArgs, index=i)) for i in range(len(vmafSegments))]
+        pending.append([mainSrc, jobIds, myVmaf, result])
+
+    jobs = {job['id']: job for job in queue.wait([jobId for item in pending for jobId in item[1]], cancel)}
+    for mainSrc, jobIds, myVmaf, result in pending:
+        mainJobs = [jobs[jobId] for jobId in jobIds]
+        failed = [job for job in mainJobs if job['state'] != JOB_DONE]
+        if failed:
+            _removeParts(mainJobs)
+            summaries[mainSrc] = {'distorted': mainSrc, 'error': f"job {failed[0]['id']} {failed[0]['state']}: {failed[0]['error']}"}
+        elif myVmaf == None:
+            summaries[mainSrc] = mainJobs[0]['result']
+        else:
+            try:
+                mergeVmafLogs([job['result'] for job in mainJobs], myVmaf.ffmpegQos.vmafpath, output_fmt)
+                result.read(myVmaf)
+                result.save(myVmaf)
+                summaries[mainSrc] = result.getSummary()
+            except Exception as e:
+                summaries[mainSrc] = {'distorted': mainSrc, 'error': str(e)}
+            finally:
+                _removeParts(mainJobs)
+    return [summaries[mainSrc] for mainSrc in mainSrcs]
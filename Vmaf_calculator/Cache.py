@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import tempfile
+
+
+IDENTITY_BLOCK_SIZE = 64 * 1024
+HASH_READ_SIZE = 1024 * 1024
+
+
+def getFileIdentity(path):
+    """
+    Cheap identity of a file: absolute path, size, mtime and a hash of three blocks of its content
+    (beginning, middle and end). It changes whenever the file is replaced or rewritten.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    digest = hashlib.sha1()
+    positions = [0, max(0, stat.st_size//2 - IDENTITY_BLOCK_SIZE//2),
+                 max(0, stat.st_size - IDENTITY_BLOCK_SIZE)]
+    with open(path, 'rb') as f:
+        for position in sorted(set(positions)):
+            f.seek(position)
+            digest.update(f.read(IDENTITY_BLOCK_SIZE))
+    return [path, stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+
+def getContentIdentity(path):
+    """
+    Identity of the content of a file: size and a hash of all of it. Unlike getFileIdentity(), it has no path or mtime
+    and no unread bytes, so it is the same for copies of a file and only for them: results computed for one of them
+    can be reused for the others. The whole file is read: memoize it (see Results.ResultsStore).
+    """
+    digest = hashlib.sha1()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_READ_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size = size + len(chunk)
+    return [size, digest.hexdigest()]
+
+
+class DiskCache:
+    '''
+    Directory of cache entries addressed by key. 
+    When the entries take more than maxSize bytes, the least recently used ones are removed.
+
+    Inputs:
+        - path: cache directory. It is created if needed
+        - maxSize: size limit in bytes
+    '''
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+
+    ''' private methods '''
+
+    def _entryPath(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    ''' public methods '''
+
+    @staticmethod
+    def getKey(*parts):
+        """sha1 of any json serializable parts"""
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def getJson(self, key):
+        """It returns the data saved with key, or None if it is not in the cache"""
+        entryPath = self._entryPath(key, '.json')
+        try:
+            with open(entryPath) as f:
+                data = json.load(f)
+            os.utime(entryPath)
+        except (OSError, ValueError):
+            return None
+        return data
+
+    def putJson(self, key, data):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmpPath, self._entryPath(key, '.json'))
+        self.evict()
+
+    def getFile(self, key, ext):
+        """It returns the path of the file saved with key and extension ext, or None if it is not in the cache"""
+        entryPath = self._entryPath(key, ext)
+        try:
+            os.utime(entryPath)
+        except OSError:
+            return None
+        return entryPath
+
+    def newFile(self):
+        """path of a new temporary file in the cache directory, to be written and then saved with putFile()"""
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        return tmpPath
+
+    def putFile(self, key, ext, tmpPath):
+        """It saves a file written in newFile() path with key. The path of the entry is returned"""
+        entryPath = self._entryPath(key, ext)
+        os.replace(tmpPath, entryPath)
+        self.evict(keep=entryPath)
+        return entryPath
+
+    def evict(self, keep=None):
+        """remove the least recently used entries, but keep, until the cache fits in maxSize"""
+        entries = []
+        try:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append([stat.st_mtime, stat.st_size, entry.path])
+        except OSError:
+            return
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, entryPath in sorted(entries):
+            if total <= self.maxSize:
+                break
+            if entryPath == keep:
+                continue
+            try:
+                os.remove(entryPath)
+            except OSError:
+                continue
+            total = total - size
@@ -0,0 +1,135 @@
+import os
+import signal
+import subprocess
+import threading
+
+
+_processes = {}
+_lock = threading.Lock()
+
+
+class Cancelled(Exception):
+    '''
+    Raised by the steps of an analysis once its CancelToken is cancelled.
+    '''
+
+    def __init__(self):
+        super().__init__('Analysis cancelled')
+
+
+class CancelToken:
+    '''
+    Cooperative cancellation of an analysis, shared by all its steps (ffprobe, ffmpeg runs, sync and SSIM workers).
+    cancel() can be called from any thread: it kills the process groups started with the token, so ffmpeg stops at
+    once, and from then on check() raises Cancelled so that the steps stop instead of starting new work.
+    parent: token whose cancel() cancels this one too (i.e., a worker and each of its jobs). Release it with
+    parent.removeChild() once the token is not used anymore.
+    '''
+
+    def __init__(self, parent=None):
+        self.event = threading.Event()
+        self.children = []
+        if parent != None:
+            parent.addChild(self)
+
+    def addChild(self, child):
+        with _lock:
+            self.children.append(child)
+        if self.isCancelled():
+            child.cancel()
+
+    def removeChild(self, child):
+        with _lock:
+            if child in self.children:
+                self.children.remove(child)
+
+    def cancel(self):
+        self.event.set()
+        killAll(self)
+        with _lock:
+            children = list(self.children)
+        for child in children:
+            child.cancel()
+
+    def isCancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        """It raises Cancelled if the token is cancelled"""
+        if self.event.is_set():
+            raise Cancelled()
+
+
+def killProcess(process):
+    """It kills the process group of process: with shell=True, ffmpeg is a child of the shell"""
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def registerProcess(process, cancel=None):
+    """
+    It registers a running process (leader of its own process group) until releaseProcess(),
+    so that cancel.cancel() or killAll() stops it.
+    """
+    with _lock:
+        _processes[process] = cancel
+        if cancel != None and cancel.isCancelled():
+            killProcess(process)
+
+
+def releaseProcess(process, cancel=None):
+    """It unregisters a finished process. It raises Cancelled if it was stopped by the token"""
+    with _lock:
+        _processes.pop(process, None)
+    if cancel != None:
+        cancel.check()
+
+
+def startProcess(cmd, cancel=None, **kwargs):
+    """
+    subprocess.Popen of cmd in a new process group, registered (see registerProcess).
+    It raises Cancelled instead of starting it if the token is already cancelled.
+    """
+    if cancel != None:
+        cancel.check()
+    process = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+    registerProcess(process, cancel)
+    return process
+
+
+def waitProcess(process, cancel=None):
+    """It waits for a registered process to end and releases it (see releaseProcess). It returns its returncode"""
+    process.wait()
+    releaseProcess(process, cancel)
+    return process.returncode
+
+
+def runProcess(cmd, cancel=None, **kwargs):
+    """
+    As subprocess.check_output(cmd, stderr=subprocess.STDOUT, ...), but cancellable.
+    If the caller is interrupted (i.e., KeyboardInterrupt), the process is killed before raising.
+    """
+    process = startProcess(cmd, cancel, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    try:
+        output = process.communicate()[0]
+    except BaseException:
+        killProcess(process)
+        raise
+    finally:
+        waitProcess(process, cancel)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output)
+    return output
+
+
+def killAll(cancel=None):
+    """It kills the registered processes of the token, or all of them"""
+    with _lock:
+        for process, processCancel in list(_processes.items()):
+            if cancel == None or processCancel is cancel:
+                killProcess(process)
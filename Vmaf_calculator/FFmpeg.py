@@ -1,10 +1,18 @@
 
 import config
+import re
 import subprocess
-import json
 import os
 import shlex
+import tempfile
+import io
+import numpy as np
+from array import array
 from ffmpeg_progress_yield import FfmpegProgress
+from Cache import DiskCache, getFileIdentity
+from JsonStream import JsonStreamReader
+from Progress import readFFmpegStats
+from Cancel import startProcess, waitProcess, runProcess, registerProcess, releaseProcess, killProcess
 
 
 HD_MODEL_VERSION = 'vmaf_v0.6.1'
@@ -17,84 +25,309 @@ HD_PHONE_MODEL_NAME = 'vmaf_hd_phone'
 _4K_MODEL_VERSION = 'vmaf_4k_v0.6.1'
 _4K_MODEL_NAME = 'vmaf_4k'
 
+SSIM_FEATURE_NAME = 'float_ssim'
+MS_SSIM_FEATURE_NAME = 'float_ms_ssim'
+PSNR_FEATURE_NAME = 'psnr_y'
+
+FRAMES_ENTRIES = 'frame=interlaced_frame,pkt_size,pict_type,pts'
+PACKETS_ENTRIES = 'packet=size,pts,flags'
+NO_PTS = -2**63
+INTERLACED_FIELD_ORDERS = ['tt', 'bb', 'tb', 'bt']
+
+PROBE_DEPTHS = ['packets', 'head', 'sample', 'full']
+PROBE_HEAD_INTERVAL = '%+5'
+PROBE_SAMPLES = 5
+PROBE_SAMPLE_DURATION = 1
+
+""" preprocessing cache codecs: [extension, output options]. All of them are lossless """
+PREPROCESS_CODECS = {
+    'ffv1': ['.mkv', '-c:v ffv1 -level 3 -g 1 -slices 4 -f matroska'],
+    'x264': ['.mkv', '-c:v libx264 -preset ultrafast -qp 0 -f matroska'],
+    'y4m': ['.y4m', '-strict -1 -f yuv4mpegpipe'],
+}
+
+"""
+scaling policy: frames scored by libvmaf (and SSIM) are scaled to the model resolution with SCALE_ALGO. Proxies (sync
+thumbnails) only need a coarse match: PROXY_DOWNSCALE_ALGO averages the source pixels, so there is no aliasing, and
+PROXY_UPSCALE_ALGO is the cheapest one (see getProxyScaleAlgo)
+"""
+SCALE_ALGO = 'bicubic'
+PROXY_DOWNSCALE_ALGO = 'area'
+PROXY_UPSCALE_ALGO = 'fast_bilinear'
+
+
+def getProxyScaleAlgo(resolution, width, height):
+    """scaler of a proxy of width x height from a chain at resolution ([width, height], None if unknown)"""
+    if resolution == None or resolution[0] * resolution[1] >= width * height:
+        return PROXY_DOWNSCALE_ALGO
+    return PROXY_UPSCALE_ALGO
 
 
 
 class FFprobe:
     '''
     Class to interact with FFprobe. 
-    It gets info about stream, frames and mpeg packets
+    It gets info about stream, frames and mpeg packets.
+    Results are saved in an on-disk cache (FFprobe.cache) keyed by the identity of the video file
+    (path, size, mtime and partial content hash) and the probe options, so a file is probed only once.
+    Set FFprobe.cache to None to disable it.
 
     Inputs:
         - videoSrc: path to video
+        - cancel: CancelToken that stops ffprobe, or None
+        - depth: how much of the file is read to get the frames info:
+            - 'packets': packets of the first 5 seconds, no decode. Interlacing is taken from the stream field_order
+            - 'head': frames of the first 5 seconds (default)
+            - 'sample': frames of 'samples' intervals of 'sampleDuration' seconds spread across the file
+            - 'full': frames of the whole file
     Outputs: 
+        - getInfo(): streams, format and frames info in a single run
         - getStreamInfo()
+        - getFormatInfo()
         - getFramesInfo()
         - getPacketsInfo()
+        - getKeyframes()
     '''
     cmd = os.environ.get('FFPROBE', config.ffprobe)
+    cache = DiskCache(os.path.join(config.cache_dir, 'probe'),
+                      config.probe_cache_size) if config.probe_cache else None
 
-    def __init__(self, videoSrc, loglevel="info"):
+    def __init__(self, videoSrc, loglevel="info", depth='head', samples=PROBE_SAMPLES, sampleDuration=PROBE_SAMPLE_DURATION, cancel=None):
         self.videoSrc = videoSrc
+        self.cancel = cancel
         self.loglevel = loglevel
+        self.depth = depth
+        self.samples = samples
+        self.sampleDuration = sampleDuration
         self.streamInfo = None
+        self.formatInfo = None
         self.framesInfo = None
         self.packetsInfo = None
 
     ''' private methods '''
 
-    def _commit(self, opt):
-        self.cmd = f'{FFprobe.cmd} -hide_banner -loglevel {self.loglevel} -print_format json {opt} -select_streams v -i \"{self.videoSrc}\" -read_intervals %+5'
+    def _commit(self, opts, readIntervals=None):
+        if '-show_frames' in opts:
+            """ only the frame fields used by the analyzer are printed """
+            opts = [opt for opt in opts if opt != '-show_frames'] + ['-show_entries', FRAMES_ENTRIES]
+        if '-show_packets' in opts:
+            opts = [opt for opt in opts if opt != '-show_packets'] + ['-show_entries', PACKETS_ENTRIES]
+        self.opt = opts + ['-select_streams', 'v']
+        if readIntervals:
+            self.opt = self.opt + ['-read_intervals', readIntervals]
+        self.cmd = [FFprobe.cmd, '-hide_banner', '-loglevel', self.loglevel, '-print_format', 'json'] + \
+            self.opt + ['-i', self.videoSrc]
+
+    def _getReadIntervals(self):
+        """-read_intervals option for the frames/packets of the probe depth"""
+        if self.depth == 'full':
+            return None
+        if self.depth == 'sample':
+            formatInfo = self.formatInfo or self.getFormatInfo()
+            start = float(formatInfo.get('start_time', 0))
+            duration = float(formatInfo.get('duration', 0))
+            if duration <= self.samples * self.sampleDuration:
+                return None
+            intervals = []
+            for i in range(self.samples):
+                position = start + duration * (i + 0.5) / self.samples - self.sampleDuration / 2
+                intervals.append(f'{position:.3f}%+{self.sampleDuration}')
+            return ','.join(intervals)
+        return PROBE_HEAD_INTERVAL
 
     def _run(self):
+        """
+        It runs ffprobe and parses its json output incrementally. Frames and packets are not kept as a list of dicts:
+        they are folded into a FramesInfo (compact columns) while ffprobe is still writing.
+        """
+        key = None
+        if FFprobe.cache != None and os.path.isfile(self.videoSrc):
+            key = FFprobe.cache.getKey(getFileIdentity(self.videoSrc), self.opt)
+            info = FFprobe.cache.getJson(key)
+            if info != None:
+                for section in ['frames', 'packets']:
+                    if section in info:
+                        info[section] = FramesInfo.fromJson(info[section])
+                return info
+
         if self.loglevel == "verbose":
-            print(self.cmd, flush=True)
-        return json.loads(subprocess.check_output(self.cmd, shell=True))
+            print(shlex.join(self.cmd), flush=True)
+        framesInfo = FramesInfo()
+        process = startProcess(self.cmd, self.cancel, stdout=subprocess.PIPE)
+        try:
+            with io.TextIOWrapper(process.stdout, encoding='utf-8') as stdout:
+                info = JsonStreamReader(
+                    stdout, {'frames': framesInfo.append, 'packets': framesInfo.appendPacket}).read()
+        except BaseException:
+            killProcess(process)
+            raise
+        finally:
+            waitProcess(process, self.cancel)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, self.cmd)
+        if FRAMES_ENTRIES in self.opt:
+            info['frames'] = framesInfo
+        if PACKETS_ENTRIES in self.opt:
+            if 'streams' in info and info['streams'][0].get('field_order') in INTERLACED_FIELD_ORDERS:
+                framesInfo.setInterlaced()
+            info['packets'] = framesInfo
+
+        if key != None:
+            cacheInfo = dict(info)
+            for section in ['frames', 'packets']:
+                if section in info:
+                    cacheInfo[section] = info[section].toJson()
+            FFprobe.cache.putJson(key, cacheInfo)
+        return info
 
     ''' public methods '''
 
+    def getInfo(self):
+        """
+        Streams, format and frames info in a single ffprobe run, according to the probe depth.
+        With depth='packets' the frames info is built from packets, without decoding.
+        With depth='sample' the format is probed first (no decode) to spread the intervals.
+        """
+        if self.depth == 'packets':
+            self._commit(['-show_streams', '-show_format', '-show_packets'], self._getReadIntervals())
+            info = self._run()
+            self.packetsInfo = info['packets']
+            self.framesInfo = info['packets']
+        else:
+            self._commit(['-show_streams', '-show_format', '-show_frames'], self._getReadIntervals())
+            info = self._run()
+            self.framesInfo = info['frames']
+        self.streamInfo = info['streams'][0]
+        self.formatInfo = info['format']
+        return self.streamInfo, self.formatInfo, self.framesInfo
+
     def getStreamInfo(self):
-        self._commit('-show_streams')
+        self._commit(['-show_streams'])
         self.streamInfo = self._run()['streams'][0]
         return self.streamInfo
 
     def getFramesInfo(self):
-        self._commit('-show_frames')
+        self._commit(['-show_frames'], self._getReadIntervals())
         self.framesInfo = self._run()['frames']
         return self.framesInfo
 
     def getPacketsInfo(self):
-        self._commit('-show_packets')
+        self._commit(['-show_streams', '-show_packets'], self._getReadIntervals())
         self.packetsInfo = self._run()['packets']
         return self.packetsInfo
 
     def getFormatInfo(self):
-        self._commit('-show_format')
-        self.packetsInfo = self._run()['format']
-        return self.packetsInfo
+        self._commit(['-show_format'])
+        self.formatInfo = self._run()['format']
+        return self.formatInfo
+
+    def getKeyframes(self):
+        """
+        times (seconds from the start of the stream) of the keyframes of the whole file, in order.
+        They are read from the packets flags, without decoding, whatever the probe depth.
+        """
+        self._commit(['-show_streams', '-show_packets'])
+        info = self._run()
+        stream = info['streams'][0]
+        num, den = stream.get('time_base', '1/1').split('/')
+        timeBase = int(num) / int(den)
+        start = float(stream.get('start_time', 0))
+        packets = info['packets']
+        return sorted(packets.pts[i] * timeBase - start for i in range(len(packets))
+                      if packets.pictType[i] == ord('I') and packets.pts[i] != NO_PTS)
+
+
+class FramesInfo:
+    '''
+    Compact columnar storage of the ffprobe frames fields used by the analyzer:
+    interlaced_frame, pkt_size, pict_type and pts. Packets can be stored too (appendPacket).
+    The summary (interlacedFrames, bytesFramesTotal) is updated as frames are appended.
+    '''
+
+    def __init__(self):
+        self.interlaced = array('b')
+        self.pktSize = array('q')
+        self.pictType = bytearray()
+        self.pts = array('q')
+        self.interlacedFrames = 0
+        self.bytesFramesTotal = 0
+
+    def __len__(self):
+        return len(self.pktSize)
+
+    def __getitem__(self, i):
+        return {'interlaced_frame': self.interlaced[i], 'pkt_size': self.pktSize[i],
+                'pict_type': chr(self.pictType[i]), 'pts': self.pts[i]}
+
+    def append(self, frame):
+        interlaced = int(frame.get('interlaced_frame', 0))
+        pktSize = int(frame.get('pkt_size', 0))
+        self.interlaced.append(interlaced)
+        self.pktSize.append(pktSize)
+        self.pictType.append(ord(frame.get('pict_type', '?')[0]))
+        self.pts.append(int(frame.get('pts', NO_PTS)))
+        self.interlacedFrames = self.interlacedFrames + interlaced
+        self.bytesFramesTotal = self.bytesFramesTotal + pktSize
+
+    def appendPacket(self, packet):
+        """packets are stored as frames: keyframes as 'I', the others with unknown picture type"""
+        pictType = 'I' if 'K' in packet.get('flags', '') else '?'
+        self.append({'pkt_size': packet.get('size', 0), 'pict_type': pictType,
+                     'pts': packet.get('pts', NO_PTS)})
+
+    def setInterlaced(self):
+        """mark every frame as interlaced. i.e., from the stream field_order when frames are not decoded"""
+        self.interlaced = array('b', [1]) * len(self)
+        self.interlacedFrames = len(self)
+
+    def toJson(self):
+        return {'interlaced_frame': self.interlaced.tolist(), 'pkt_size': self.pktSize.tolist(),
+                'pict_type': self.pictType.decode('ascii'), 'pts': self.pts.tolist()}
+
+    @staticmethod
+    def fromJson(data):
+        framesInfo = FramesInfo()
+        framesInfo.interlaced = array('b', data['interlaced_frame'])
+        framesInfo.pktSize = array('q', data['pkt_size'])
+        framesInfo.pictType = bytearray(data['pict_type'], 'ascii')
+        framesInfo.pts = array('q', data['pts'])
+        framesInfo.interlacedFrames = sum(framesInfo.interlaced)
+        framesInfo.bytesFramesTotal = sum(framesInfo.pktSize)
+        return framesInfo
 
 
 class FFmpegQos:
     '''
-    Class to interact with FFmpeg QoS Filters: PSNR and VMAF. 
-    Particullary, it interacts with libvmaf library through lavfi filter
+    Class to interact with FFmpeg QoS Filters: VMAF, and luma outputs for sync and SSIM. 
+    Particullary, it interacts with libvmaf library through lavfi filter.
+    Extra libvmaf features (psnr, float_ssim, float_ms_ssim, cambi) are computed in the same decode pass as VMAF
+    ffmpeg runs are stopped by 'cancel' (CancelToken), if given. Then partial libvmaf logs are removed.
     '''
     cmd = os.environ.get('FFMPEG', config.ffmpeg)
 
-    def __init__(self,  main, ref, loglevel="info"):
+    def __init__(self,  main, ref, loglevel="info", cancel=None, mainResolution=None, refResolution=None, mainFps=None, refFps=None):
+        """
+        mainResolution, refResolution: [width, height] of the videos, if known, so scale nodes are only added when needed
+        mainFps, refFps: frame rates of the videos, if known. They are tracked along the chains (see getComparedFps)
+        """
         self.loglevel = loglevel
+        self.cancel = cancel
         self.cmd = None
-        self.main = inputFFmpeg(main, input_id=0)
-        self.ref = inputFFmpeg(ref, input_id=1)
-        self.psnrFilter = []
+        self.main = inputFFmpeg(main, input_id=0, resolution=mainResolution, fps=mainFps)
+        self.ref = inputFFmpeg(ref, input_id=1, resolution=refResolution, fps=refFps)
         self.vmafFilter = []
+        self.lumaFilter = []
+        self.lumaOutputs = []
         self.invertedSrc = False
         self.vmafpath = None
         self.vmaf_cambi_heatmap_path = None
+        self.filterThreads = None
 
     def _commit(self):
         """build the final cmd to run"""
         baseCmd = f'{FFmpegQos.cmd} -y -hide_banner -stats -loglevel {self.loglevel} '
+        if self.filterThreads:
+            baseCmd = f'{baseCmd}-filter_complex_threads {self.filterThreads} '
         inputsCmd = self._commitInputs()
         filterCmd = self._commitFilters()
         outputCmd = self._commitOutputs()
@@ -102,56 +335,126 @@ class FFmpegQos:
 
     def _commitInputs(self):
         """build the cmd for the inputs files"""
-        inputCmd = f'-i \"{self.main.videoSrc}\" -i \"{self.ref.videoSrc}\" -map 0:v -map 1:v'
+        inputCmd = f'{self.main.getInputCmd()} {self.ref.getInputCmd()}'
+        if not self.lumaOutputs:
+            inputCmd = f'{inputCmd} -map 0:v -map 1:v'
         return inputCmd
 
     def _commitOutputs(self):
+        if self.lumaOutputs:
+            return " ".join(self.lumaOutputs)
         return "-f null -"
 
     def _commitFilters(self, filterName='lavfi'):
         """build the cmd for the filters"""
-        filterCmd = f'-{filterName} \'{";".join(self.main.filtersList + self.ref.filtersList + self.psnrFilter + self.vmafFilter)}\''
+        filterCmd = f'-{filterName} \'{";".join(self.main.filtersList + self.ref.filtersList + self.vmafFilter + self.lumaFilter)}\''
         return filterCmd
 
-    def getPsnr(self, stats_file=False):
-        """ 
-        It adds PSNR filter to lavfi chain and run the ffmpeg cmd.
-        The output is returned and saved as stats_file_psnr.log
+    def getGraph(self):
         """
-        main = self.main.lastOutputID
-        ref = self.ref.lastOutputID
-        if stats_file == True:
-            stats_file = os.path.splitext(self.main.videoSrc)[0] + '_psnr.log'
-        else:
-            stats_file = 'stats_file_psnr.log'
-
-        self.psnrFilter = [f'[{main}][{ref}]psnr=stats_file={stats_file}']
+        filter graph of the cmd without the libvmaf log paths, log format and threads, that do not change the scores.
+        With the inputs, it identifies the result of a run (see Results.ResultsStore).
+        """
+        graph = ";".join(self.main.filtersList + self.ref.filtersList + self.vmafFilter + self.lumaFilter)
+        if self.vmafpath != None:
+            graph = graph.replace(f'log_path={self.vmafpath}', 'log_path=')
+        if self.vmaf_cambi_heatmap_path != None:
+            graph = graph.replace(f'heatmaps_path={self.vmaf_cambi_heatmap_path}', 'heatmaps_path=')
+        graph = re.sub(r'n_threads=\d+', 'n_threads=', graph)
+        return re.sub(r'log_fmt=\w+', 'log_fmt=', graph)
+
+    def getLumaFrames(self, fps, width, height, algo=None, reporter=None):
+        """
+        It decodes MAIN and REF through their filter chains once, in a single ffmpeg run,
+        and returns both as uint8 arrays of luma frames with shape (frames, height, width).
+        Both outputs are resampled to the same fps so that frame i of each array is at time i/fps.
+        They are proxies: unless algo is given, each chain is scaled with getProxyScaleAlgo().
+        reporter: ProgressReporter updated with the frames of REF decoded (ffmpeg stats count its output, the first one)
+        """
+        with tempfile.TemporaryDirectory(prefix='vmaf_luma_') as tmpDir:
+            paths = {}
+            self.lumaFilter = []
+            self.lumaOutputs = []
+            for stream in [self.ref, self.main]:
+                path = os.path.join(tmpDir, f'{stream.name}luma.gray')
+                scale = stream.getScaleOption(width, height, algo or getProxyScaleAlgo(stream.resolution, width, height))
+                self.lumaFilter.append(
+                    f'[{stream.lastOutputID}]fps=fps={fps},{scale}format=gray[{stream.name}luma]')
+                self.lumaOutputs.append(
+                    f'-map [{stream.name}luma] -f rawvideo -pix_fmt gray \"{path}\"')
+                paths[stream.name] = path
+            self._commit()
+            self.lumaFilter = []
+            self.lumaOutputs = []
+
+            if self.loglevel == "verbose":
+                print(self.cmd, flush=True)
+            if reporter == None:
+                runProcess(self.cmd, self.cancel, shell=True)
+            else:
+                process = startProcess(
+                    self.cmd, self.cancel, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, shell=True)
+                try:
+                    readFFmpegStats(process.stderr, reporter)
+                except BaseException:
+                    killProcess(process)
+                    raise
+                finally:
+                    waitProcess(process, self.cancel)
+                if process.returncode != 0:
+                    raise subprocess.CalledProcessError(process.returncode, self.cmd)
+
+            frames = [np.fromfile(paths[stream.name], dtype=np.uint8).reshape(-1, height, width)
+                      for stream in [self.main, self.ref]]
+        return frames[0], frames[1]
+
+    def getLumaPipe(self, width, height, subsample=1, algo=SCALE_ALGO):
+        """
+        It starts ffmpeg writing to stdout, as rawvideo, the luma of MAIN stacked over REF (one 2*height x width frame
+        per pair), both scaled to width x height after their filter chains, unless they are at width x height already.
+        It stops at the end of the shortest one.
+        Only one every 'subsample' frames is selected, before scaling. Frames are passed through, so the muxer does
+        not duplicate them to keep a constant rate. It returns the running process: release it with waitProcess().
+        """
+        self.lumaFilter = []
+        for stream in [self.main, self.ref]:
+            selectFilter = ''
+            if subsample > 1:
+                selectFilter = f'framestep={subsample},'
+            scale = stream.getScaleOption(width, height, algo)
+            self.lumaFilter.append(
+                f'[{stream.lastOutputID}]{selectFilter}{scale}format=gray[{stream.name}luma]')
+        self.lumaFilter.append(f'[{self.main.name}luma][{self.ref.name}luma]vstack=shortest=1[luma]')
+        self.lumaOutputs = ['-map [luma] -vsync passthrough -f rawvideo -pix_fmt gray -']
         self._commit()
+        self.lumaFilter = []
+        self.lumaOutputs = []
 
         if self.loglevel == "verbose":
             print(self.cmd, flush=True)
-        stdout = (subprocess.check_output(
-            self.cmd, stderr=subprocess.STDOUT, shell=True)).decode('utf-8')
-        stdout = stdout.split(" ")
-        psnr = [s for s in stdout if "average" in s][0].split(":")[1]
-        return float(psnr)
+        return startProcess(self.cmd, self.cancel, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, shell=True)
 
-    def getVmaf(self, log_path=None, model='HD', subsample=1, output_fmt='json', threads=0, print_progress=False, end_sync=False, features = None, cambi_heatmap = False):
+    def setVmafFilter(self, log_path=None, model='HD', subsample=1, output_fmt='json', threads=0, end_sync=False, features = None, cambi_heatmap = False, log_base=None, outputID=None):
+        """
+        It adds the libvmaf filter, between the last outputs of MAIN and REF chains, to the lavfi chain.
+        log_base: path, without extension, of the output files (vmaf log and cambi heatmap). Default: MAIN video path
+        outputID: label of the libvmaf output, if it has to be mapped
+        """
         main = self.main.lastOutputID
         ref = self.ref.lastOutputID
+        if log_base == None:
+            log_base = os.path.splitext(self.main.videoSrc)[0]
         if output_fmt == 'xml':
             log_fmt = "xml"
             if log_path == None:
-                log_path = os.path.splitext(self.main.videoSrc)[
-                    0] + '_vmaf.xml'
+                log_path = log_base + '_vmaf.xml'
         else:
             log_fmt = "json"
             if log_path == None:
-                log_path = os.path.splitext(self.main.videoSrc)[
-                    0] + '_vmaf.json'
+                log_path = log_base + '_vmaf.json'
         self.vmafpath = log_path
 
-        self.vmaf_cambi_heatmap_path = os.path.splitext(self.main.videoSrc)[0] + '_cambi_heatmap'
+        self.vmaf_cambi_heatmap_path = log_base + '_cambi_heatmap'
 
 
 
@@ -167,48 +470,236 @@ class FFmpegQos:
             shortest = 1
         else:
             shortest = 0
+        output = f'[{outputID}]' if outputID != None else ''
 
         if not features:
-            self.vmafFilter = [f'[{main}][{ref}]libvmaf=log_fmt={log_fmt}:model={model}:n_subsample={subsample}:log_path={log_path}:n_threads={threads}:shortest={shortest}']
+            self.vmafFilter = [f'[{main}][{ref}]libvmaf=log_fmt={log_fmt}:model={model}:n_subsample={subsample}:log_path={log_path}:n_threads={threads}:shortest={shortest}{output}']
         
         elif features and not cambi_heatmap:
-            self.vmafFilter = [f'[{main}][{ref}]libvmaf=log_fmt={log_fmt}:model={model}:n_subsample={subsample}:log_path={log_path}:n_threads={threads}:shortest={shortest}:feature={features}']
+            self.vmafFilter = [f'[{main}][{ref}]libvmaf=log_fmt={log_fmt}:model={model}:n_subsample={subsample}:log_path={log_path}:n_threads={threads}:shortest={shortest}:feature={features}{output}']
 
         elif features and cambi_heatmap:
-            self.vmafFilter = [f'[{main}][{ref}]libvmaf=log_fmt={log_fmt}:model={model}:n_subsample={subsample}:log_path={log_path}:n_threads={threads}:shortest={shortest}:feature={features}\\\\:heatmaps_path={self.vmaf_cambi_heatmap_path}']
-
+            self.vmafFilter = [f'[{main}][{ref}]libvmaf=log_fmt={log_fmt}:model={model}:n_subsample={subsample}:log_path={log_path}:n_threads={threads}:shortest={shortest}:feature={features}\\\\:heatmaps_path={self.vmaf_cambi_heatmap_path}{output}']
 
+    def _run(self, print_progress=False, reporter=None):
+        """
+        commit and run the ffmpeg cmd until it ends.
+        reporter: ProgressReporter updated with the frame and fps of the ffmpeg stats
+        libvmaf logs of a previous run at the same paths are removed first, so they are never read as the ones of this run.
+        If it is cancelled or interrupted, ffmpeg is killed and the partial libvmaf logs are removed.
+        If ffmpeg fails, CalledProcessError is raised (RuntimeError with print_progress) and the logs are removed too.
+        """
         self._commit()
         if self.loglevel == "verbose":
             print(self.cmd, flush=True)
+        self._removeLogs()
+
+        try:
+            if print_progress:
+                cmd_progress = shlex.split(self.cmd)
+                process = FfmpegProgress(cmd_progress)
+                registered = None
+                try:
+                    for progress in process.run_command_with_progress({'start_new_session': True}):
+                        if registered == None:
+                            registered = process.process
+                            registerProcess(registered, self.cancel)
+                        print(f"progress = {progress}% - ",
+                              "\n".join(str(process.stderr).splitlines()[-9:-8]),
+                              flush=True)
+                finally:
+                    if registered != None:
+                        releaseProcess(registered, self.cancel)
+                if self.cancel != None:
+                    self.cancel.check()
+
+            elif reporter != None:
+                process = startProcess(
+                    self.cmd, self.cancel, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, shell=True)
+                try:
+                    readFFmpegStats(process.stderr, reporter)
+                except BaseException:
+                    killProcess(process)
+                    raise
+                finally:
+                    waitProcess(process, self.cancel)
+                if process.returncode != 0:
+                    raise subprocess.CalledProcessError(process.returncode, self.cmd)
+                reporter.finish()
+
+            else:
+                process = startProcess(
+                    self.cmd, self.cancel, stdout=subprocess.PIPE, shell=True)
+                try:
+                    process.communicate()
+                except BaseException:
+                    killProcess(process)
+                    raise
+                finally:
+                    waitProcess(process, self.cancel)
+                if process.returncode != 0:
+                    raise subprocess.CalledProcessError(process.returncode, self.cmd)
+
+        except BaseException:
+            self._removeLogs()
+            raise
 
-        if print_progress:
-            cmd_progress = shlex.split(self.cmd)
-            process = FfmpegProgress(cmd_progress)
-            for progress in process.run_command_with_progress():
-                print(f"progress = {progress}% - ",
-                      "\n".join(str(process.stderr).splitlines()[-9:-8]),
-                      flush=True)
+        return process
 
-        else:
-            process = subprocess.Popen(
-                self.cmd, stdout=subprocess.PIPE, shell=True)
-            process.communicate()
+    def _getLogPaths(self):
+        """libvmaf log files written by the cmd"""
+        if self.vmafFilter and self.vmafpath != None:
+            return [self.vmafpath]
+        return []
 
-        return process
+    def _removeLogs(self):
+        for path in self._getLogPaths():
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def getVmaf(self, log_path=None, model='HD', subsample=1, output_fmt='json', threads=0, print_progress=False, end_sync=False, features = None, cambi_heatmap = False, log_base=None, reporter=None):
+        """
+        It adds the libvmaf filter (see setVmafFilter) and runs the ffmpeg cmd
+        """
+        self.setVmafFilter(log_path, model, subsample, output_fmt, threads,
+                           end_sync, features, cambi_heatmap, log_base)
+        return self._run(print_progress, reporter)
 
     def clearFilters(self):
-        self.psnrFilter = []
         self.vmafFilter = []
+        self.lumaFilter = []
+        self.lumaOutputs = []
+
+    def getComparedFps(self):
+        """frame rate of the frames compared: the lowest output frame rate of the MAIN and REF chains. None if unknown"""
+        rates = [stream.fps for stream in [self.main, self.ref] if stream.fps != None]
+        return min(rates) if rates else None
 
     def invertSrcs(self):
         temp1 = self.main.videoSrc
         temp2 = self.ref.videoSrc
         invertedSrc = self.invertedSrc
-        self.__init__(temp2, temp1, self.loglevel)
+        self.__init__(temp2, temp1, self.loglevel, self.cancel, self.ref.sourceResolution, self.main.sourceResolution,
+                      self.ref.sourceFps, self.main.sourceFps)
         self.invertedSrc = not (invertedSrc)
 
 
+class FFmpegQosLadder(FFmpegQos):
+    '''
+    Class to compute VMAF of several MAIN videos (i.e., the rungs of an encoding ladder) against the same REF in a single
+    ffmpeg run. REF is input 0 and it is decoded once: its shared chain (FFmpegQosLadder.ref) is split into one branch per MAIN.
+    Each rung is an FFmpegQos (FFmpegQosLadder.rungs) whose REF chain starts at its branch, so MAIN and REF filter chains
+    of every rung are managed as usual. Each rung has its own libvmaf filter (setVmafFilter) and log.
+    '''
+
+    def __init__(self, ref, mains, loglevel="info", refResolution=None, cancel=None, mainResolutions=None, refFps=None, mainFps=None):
+        """mainResolutions, mainFps: [width, height] and frame rate of each MAIN, if known"""
+        super().__init__(mains[0], ref, loglevel, cancel)
+        if mainResolutions == None:
+            mainResolutions = [None] * len(mains)
+        if mainFps == None:
+            mainFps = [None] * len(mains)
+        self.main = None
+        self.ref = inputFFmpeg(ref, input_id=0, resolution=refResolution, fps=refFps)
+        self.splitFilter = []
+        self.rungs = []
+        for i, main in enumerate(mains):
+            rung = FFmpegQos(main, ref, loglevel, cancel)
+            rung.main = inputFFmpeg(main, input_id=i + 1, resolution=mainResolutions[i], fps=mainFps[i])
+            rung.ref = inputFFmpeg(ref, input_id=0, name=f'input0b{i}_', sourceID=f'input0s{i}', fps=refFps)
+            self.rungs.append(rung)
+
+    def _commitInputs(self):
+        """build the cmd for the inputs files"""
+        return " ".join(stream.getInputCmd() for stream in [self.ref] + [rung.main for rung in self.rungs])
+
+    def _commitOutputs(self):
+        return " ".join(f'-map [vmaf{i}]' for i in range(len(self.rungs))) + " -f null -"
+
+    def _commitFilters(self, filterName='lavfi'):
+        """build the cmd for the filters"""
+        filters = self.ref.filtersList + self.splitFilter
+        for rung in self.rungs:
+            filters = filters + rung.main.filtersList + rung.ref.filtersList + rung.vmafFilter
+        filterCmd = f'-{filterName} \'{";".join(filters)}\''
+        return filterCmd
+
+    def _getLogPaths(self):
+        """libvmaf log files written by the cmd: one per rung"""
+        return [path for rung in self.rungs for path in rung._getLogPaths()]
+
+    def split(self):
+        """
+        It splits the end of the shared REF chain into the branches of the rungs.
+        Rung REF chains are cleared and they start at the resolution and frame rate of the shared chain.
+        """
+        branches = "".join(f'[{rung.ref.sourceID}]' for rung in self.rungs)
+        self.splitFilter = [f'[{self.ref.lastOutputID}]split={len(self.rungs)}{branches}']
+        for rung in self.rungs:
+            rung.ref.sourceResolution = self.ref.resolution
+            rung.ref.sourceFps = self.ref.fps
+            rung.ref.clearFilters()
+
+    def getVmaf(self, print_progress=False, reporter=None):
+        """
+        It runs the ffmpeg cmd. The libvmaf filter of rung i must be set before with setVmafFilter(..., outputID=f'vmaf{i}')
+        """
+        return self._run(print_progress, reporter)
+
+
+class FFmpegPreprocess:
+    '''
+    Class to write a preprocessed copy of a video (i.e., denoised or brightness adjusted), for when it must be kept.
+    Its filter chain is managed by an inputFFmpeg (FFmpegPreprocess.input) and the copy is written with a lossless
+    (ffv1, x264 qp 0) or raw (y4m) codec, so no coding artifacts are added to the score.
+    Copies are saved in an on-disk cache (FFmpegPreprocess.cache) keyed by the identity of the video file, the
+    filter chain and the codec, so repeated runs reuse them. The least recently used copies are removed first.
+    '''
+    cmd = os.environ.get('FFMPEG', config.ffmpeg)
+    cache = DiskCache(os.path.join(config.cache_dir, 'preprocess'),
+                      config.preprocess_cache_size)
+
+    def __init__(self, videoSrc, loglevel="info", codec='ffv1', cancel=None):
+        self.loglevel = loglevel
+        self.cancel = cancel
+        self.videoSrc = videoSrc
+        self.codec = codec
+        self.input = inputFFmpeg(videoSrc, input_id=0)
+        self.cmd = None
+
+    def _commit(self, outputPath):
+        """build the final cmd to run"""
+        codecOpts = PREPROCESS_CODECS[self.codec][1]
+        self.cmd = (f'{FFmpegPreprocess.cmd} -y -hide_banner -stats -loglevel {self.loglevel} '
+                    f'-i \"{self.videoSrc}\" -lavfi \'{";".join(self.input.filtersList)}\' '
+                    f'-map [{self.input.lastOutputID}] -an {codecOpts} \"{outputPath}\"')
+
+    def getPath(self):
+        """
+        It returns the path of the preprocessed copy, writing it if it is not in the cache yet.
+        Without filters, the video itself is returned.
+        """
+        if not self.input.filtersList:
+            return self.videoSrc
+        ext = PREPROCESS_CODECS[self.codec][0]
+        key = FFmpegPreprocess.cache.getKey(
+            getFileIdentity(self.videoSrc), self.input.filtersList, self.codec)
+        path = FFmpegPreprocess.cache.getFile(key, ext)
+        if path != None:
+            return path
+
+        tmpPath = FFmpegPreprocess.cache.newFile()
+        self._commit(tmpPath)
+        if self.loglevel == "verbose":
+            print(self.cmd, flush=True)
+        try:
+            runProcess(self.cmd, self.cancel, shell=True)
+        except BaseException:
+            os.remove(tmpPath)
+            raise
+        return FFmpegPreprocess.cache.putFile(key, ext, tmpPath)
+
+
 class inputFFmpeg:
     '''
     Class to interact with FFmpeg inputs. 
@@ -220,24 +711,44 @@ class inputFFmpeg:
     - setDeintFieldFilter()
     - setTrimFilter()
     - setFpsFilter()
+    - setBrightnessFilter()
+    - setDenoiseFilter()
     - clearFilters()
     '''
 
-    def __init__(self, videoSrc, input_id):
-        self.name = f'input{input_id}_'
+    def __init__(self, videoSrc, input_id, name=None, sourceID=None, resolution=None, fps=None):
+        """
+        name: prefix of the labels of the chain (default: input{input_id}_)
+        sourceID: label the chain starts from (default: the video stream of the input, {input_id}:v)
+        resolution: [width, height] at sourceID, if known. It is tracked along the chain (see resolution)
+        fps: frame rate at sourceID, if known. It is tracked along the chain (see fps): fps and field deinterlacing
+        filters change it
+        """
+        self.name = name if name != None else f'input{input_id}_'
         self.id = input_id
         self.videoSrc = videoSrc
+        self.sourceID = sourceID if sourceID != None else f'{str(self.id)}:v'
+        self.sourceResolution = resolution
+        self.resolution = resolution
+        self.sourceFps = fps
+        self.fps = fps
         self.filtersList = []
         self.extraOptions = []
-        self.lastOutputID = f'{str(self.id)}:v'
+        self.decodeThreads = None
+        self.lastOutputID = self.sourceID
 
     def _setFilter(self, filter):
         self.filtersList.append(filter)
 
+    def getInputCmd(self):
+        """-i option of videoSrc, preceded by its input options (extraOptions, i.e., -ss to seek) and decoder threads"""
+        threadsOptions = ['-threads', str(self.decodeThreads)] if self.decodeThreads else []
+        return " ".join(self.extraOptions + threadsOptions + [f'-i \"{self.videoSrc}\"'])
+
     def _newInOutForFilter(self):
         self.n = len(self.filtersList)
         if self.n == 0:
-            inputID = f'{str(self.id)}:v'
+            inputID = self.sourceID
             outputID = f'{self.name}{str(self.n)}'
         else:
             inputID = f'{self.name}{str(self.n-1)}'
@@ -247,12 +758,21 @@ class inputFFmpeg:
     def _updateOutputId(self, outputID):
         self.lastOutputID = outputID
 
-    def setScaleFilter(self, width, height, algo='bicubic'):
-        """Filter options for Upscale or Downscale"""
+    def getScaleOption(self, width, height, algo=SCALE_ALGO):
+        """scale filter to width x height, followed by a comma, to chain it in a filter. Empty if the chain is already at it"""
+        if self.resolution == [width, height]:
+            return ''
+        return f'scale={width}:{height}:flags={algo},'
+
+    def setScaleFilter(self, width, height, algo=SCALE_ALGO):
+        """Filter options for Upscale or Downscale. Nothing is added if the chain is already at width x height"""
+        if self.resolution == [width, height]:
+            return
         inputID, outputID = self._newInOutForFilter()
         scaleFilter = f'[{inputID}]scale={width}:{height}:flags={algo}[{outputID}]'
         self._setFilter(scaleFilter)
         self._updateOutputId(outputID)
+        self.resolution = [width, height]
 
     def setOffsetFilter(self, offset):
         """set offset for videoSrc: time to wait before display frames"""
@@ -280,8 +800,11 @@ class inputFFmpeg:
         yadifFilter = f'[{inputID}]yadif={yadifOpt}[{outputID}]'
         self._setFilter(yadifFilter)
         self._updateOutputId(outputID)
+        if self.fps != None:
+            self.fps = self.fps * 2
 
     def setTrimFilter(self, start, duration):
+        """frames from start, for duration (seconds). Timestamps start at 0 again"""
         inputID, outputID = self._newInOutForFilter()
         trimFilter = f'[{inputID}]trim=start={start}:duration={duration}, setpts=PTS-STARTPTS[{outputID}]'
         self._setFilter(trimFilter)
@@ -293,7 +816,24 @@ class inputFFmpeg:
         fpsFilter = f'[{inputID}]fps=fps={fps}[{outputID}]'
         self._setFilter(fpsFilter)
         self._updateOutputId(outputID)
+        self.fps = float(fps)
+
+    def setBrightnessFilter(self, factor):
+        """Brightness adjustment: factor 1.0 is the original brightness"""
+        inputID, outputID = self._newInOutForFilter()
+        eqFilter = f'[{inputID}]eq=brightness={factor - 1.0:g}[{outputID}]'
+        self._setFilter(eqFilter)
+        self._updateOutputId(outputID)
+
+    def setDenoiseFilter(self):
+        """High quality 3D denoise, default strength"""
+        inputID, outputID = self._newInOutForFilter()
+        denoiseFilter = f'[{inputID}]hqdn3d[{outputID}]'
+        self._setFilter(denoiseFilter)
+        self._updateOutputId(outputID)
 
     def clearFilters(self):
         self.filtersList = []
-        self.lastOutputID = f'{str(self.id)}:v'
+        self.lastOutputID = self.sourceID
+        self.resolution = self.sourceResolution
+        self.fps = self.sourceFps
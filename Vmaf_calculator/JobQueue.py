@@ -0,0 +1,271 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from Cancel import CancelToken, Cancelled
+
+
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 60
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 1
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+JOB_ENDED = [JOB_DONE, JOB_FAILED, JOB_CANCELLED]
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, args TEXT, state TEXT, worker TEXT, attempts INTEGER,
+        heartbeat REAL, result TEXT, error TEXT, created REAL, updated REAL)''',
+    '''CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)''',
+    '''CREATE TABLE IF NOT EXISTS workers (
+        id TEXT PRIMARY KEY, host TEXT, pid INTEGER, job INTEGER, heartbeat REAL, started REAL)''',
+]
+
+
+def getWorkerId(index=0):
+    """id of a worker of this process: host, pid and index of the worker in the process"""
+    return f'{socket.gethostname()}:{os.getpid()}:{index}'
+
+
+class JobQueue:
+    '''
+    Queue of analysis jobs shared by a coordinator and workers on any host, kept in a SQLite database.
+    A coordinator submits jobs and waits for them (wait). Workers (runWorker) claim queued jobs one at a time, send
+    heartbeats while they run them and store their results. Running jobs without a heartbeat for 'timeout' seconds
+    (i.e., the worker died or its host is down) are queued again, at most 'maxAttempts' times, as failed jobs are.
+    The database must be on a filesystem every host can reach with working file locks, and the videos of the jobs
+    must be reachable with the same paths from every host.
+
+    Inputs:
+        - path: database file. It is created if needed
+        - timeout: seconds without heartbeat before a running job is queued again
+        - maxAttempts: runs of a job before it is marked as failed
+    Outputs:
+        - submit(kind, args): id of a new job
+        - claim(worker): next queued job, that runs on worker
+        - heartbeat(), complete(), fail(), release(): reports of the worker running a job
+        - getJobs(ids), wait(ids), cancelJobs(ids): jobs, as dicts
+    '''
+
+    def __init__(self, path, timeout=HEARTBEAT_TIMEOUT, maxAttempts=MAX_ATTEMPTS):
+        self.path = path
+        self.timeout = timeout
+        self.maxAttempts = maxAttempts
+
+    ''' private methods '''
+
+    def _connect(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """write transaction that takes the database lock at once, so claims of several workers never overlap"""
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                for statement in SCHEMA:
+                    db.execute(statement)
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def _requeueStale(self, db):
+        """running jobs whose worker stopped sending heartbeats are queued again (or failed)"""
+        now = time.time()
+        stale = db.execute('SELECT id FROM jobs WHERE state = ? AND heartbeat < ?',
+                           (JOB_RUNNING, now - self.timeout)).fetchall()
+        for row in stale:
+            self._retry(db, row['id'], 'heartbeat timeout', now)
+
+    def _retry(self, db, jobId, error, now):
+        db.execute('UPDATE jobs SET state = CASE WHEN attempts < ? THEN ? ELSE ? END, worker = NULL, error = ?, '
+                   'updated = ? WHERE id = ?', (self.maxAttempts, JOB_QUEUED, JOB_FAILED, error, now, jobId))
+
+    @staticmethod
+    def _toJob(row):
+        job = dict(row)
+        job['args'] = json.loads(job['args'])
+        job['result'] = json.loads(job['result']) if job['result'] != None else None
+        return job
+
+    ''' public methods '''
+
+    def submit(self, kind, args):
+        """It queues a job of 'kind' with json serializable args and returns its id"""
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute('INSERT INTO jobs (kind, args, state, attempts, created, updated) VALUES (?, ?, ?, 0, ?, ?)',
+                                (kind, json.dumps(args), JOB_QUEUED, now, now))
+            return cursor.lastrowid
+
+    def claim(self, worker):
+        """
+        It takes the oldest queued job for worker and returns it as a dict ('id', 'kind', 'args', 'attempts'...),
+        or None if there is none. Stale running jobs are queued again first.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            self._requeueStale(db)
+            row = db.execute('SELECT id FROM jobs WHERE state = ? ORDER BY id LIMIT 1', (JOB_QUEUED,)).fetchone()
+            if row == None:
+                return None
+            db.execute('UPDATE jobs SET state = ?, worker = ?, attempts = attempts + 1, heartbeat = ?, updated = ? '
+                       'WHERE id = ?', (JOB_RUNNING, worker, now, now, row['id']))
+            db.execute('UPDATE workers SET job = ?, heartbeat = ? WHERE id = ?', (row['id'], now, worker))
+            return self._toJob(db.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone())
+
+    def heartbeat(self, worker, jobId=None):
+        """
+        It records that worker is alive and, if given, still running jobId.
+        It returns False if jobId is not running on worker anymore (it was queued again or cancelled): stop it.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('INSERT INTO workers (id, host, pid, job, heartbeat, started) VALUES (?, ?, ?, ?, ?, ?) '
+                       'ON CONFLICT(id) DO UPDATE SET job = excluded.job, heartbeat = excluded.heartbeat',
+                       (worker, socket.gethostname(), os.getpid(), jobId, now, now))
+            if jobId == None:
+                return True
+            cursor = db.execute('UPDATE jobs SET heartbeat = ? WHERE id = ? AND state = ? AND worker = ?',
+                                (now, jobId, JOB_RUNNING, worker))
+            return cursor.rowcount == 1
+
+    def complete(self, jobId, worker, result):
+        """It stores the json serializable result of a job run by worker, unless the job was taken from it"""
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET state = ?, result = ?, error = NULL, updated = ? WHERE id = ? AND state = ? AND worker = ?',
+                       (JOB_DONE, json.dumps(result), time.time(), jobId, JOB_RUNNING, worker))
+
+    def fail(self, jobId, worker, error):
+        """The job failed on worker: it is queued again, or failed after maxAttempts runs"""
+        with self._transaction() as db:
+            row = db.execute('SELECT id FROM jobs WHERE id = ? AND state = ? AND worker = ?',
+                             (jobId, JOB_RUNNING, worker)).fetchone()
+            if row != None:
+                self._retry(db, jobId, error, time.time())
+
+    def release(self, jobId, worker):
+        """The worker stopped before finishing the job: it is queued again, and this run does not count as an attempt"""
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET state = ?, worker = NULL, attempts = attempts - 1, updated = ? '
+                       'WHERE id = ? AND state = ? AND worker = ?', (JOB_QUEUED, time.time(), jobId, JOB_RUNNING, worker))
+
+    def cancelJobs(self, ids):
+        """Queued and running jobs of ids are cancelled. Workers stop running ones at their next heartbeat"""
+        with self._transaction() as db:
+            db.executemany('UPDATE jobs SET state = ?, updated = ? WHERE id = ? AND state IN (?, ?)',
+                           [(JOB_CANCELLED, time.time(), jobId, JOB_QUEUED, JOB_RUNNING) for jobId in ids])
+
+    def getJobs(self, ids):
+        """jobs of ids as dicts, in ids order"""
+        with closing(self._connect()) as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+            jobs = {}
+            for row in db.execute(f'SELECT * FROM jobs WHERE id IN ({",".join("?" * len(ids))})', list(ids)):
+                jobs[row['id']] = self._toJob(row)
+        return [jobs[jobId] for jobId in ids]
+
+    def wait(self, ids, cancel=None, poll=POLL_INTERVAL):
+        """
+        It waits until the jobs of ids are done, failed or cancelled and returns them (see getJobs).
+        Stale jobs are queued again while waiting. If the wait is cancelled or interrupted, the jobs are cancelled.
+        """
+        counts = None
+        try:
+            while True:
+                with self._transaction() as db:
+                    self._requeueStale(db)
+                jobs = self.getJobs(ids)
+                states = [job['state'] for job in jobs]
+                if counts != [states.count(state) for state in [JOB_QUEUED, JOB_RUNNING, JOB_DONE]]:
+                    counts = [states.count(state) for state in [JOB_QUEUED, JOB_RUNNING, JOB_DONE]]
+                    print("[Vmaf-Calculator] Jobs:", counts[0], "queued |", counts[1], "running |",
+                          counts[2], "done of", len(ids), flush=True)
+                if all(state in JOB_ENDED for state in states):
+                    return jobs
+                if cancel != None:
+                    cancel.event.wait(poll)
+                    cancel.check()
+                else:
+                    time.sleep(poll)
+        except BaseException:
+            self.cancelJobs(ids)
+            raise
+
+
+def runWorker(queue, handler, worker=None, cancel=None, idleExit=False, poll=POLL_INTERVAL, heartbeatInterval=HEARTBEAT_INTERVAL):
+    """
+    It runs jobs of queue, one at a time, until cancel is cancelled or, with idleExit, until no job is queued.
+    handler(job, jobCancel): it runs a job (dict, see JobQueue.claim) and returns its json serializable result.
+    jobCancel (Cancel.CancelToken) is cancelled if the job is taken from the worker (heartbeat timeout or cancelled
+    by the coordinator) or if cancel is. A job that raises is queued again (see JobQueue.fail).
+    While a job runs, a thread sends its heartbeats every heartbeatInterval seconds. Failed ones are retried.
+    """
+    if worker == None:
+        worker = getWorkerId()
+    print("[Vmaf-Calculator] Worker", worker, "waiting for jobs of", queue.path, flush=True)
+    while cancel == None or not cancel.isCancelled():
+        queue.heartbeat(worker)
+        job = queue.claim(worker)
+        if job == None:
+            if idleExit:
+                return
+            if cancel != None:
+                cancel.event.wait(poll)
+            else:
+                time.sleep(poll)
+            continue
+
+        print("[Vmaf-Calculator] Worker", worker, "| job", job['id'], job['kind'], "| attempt", job['attempts'], flush=True)
+        jobCancel = CancelToken(cancel)
+        stop = threading.Event()
+
+        def beat():
+            """ a locked database (busy timeout) does not stop the heartbeats: they are retried after poll seconds """
+            interval = heartbeatInterval
+            while not stop.wait(interval):
+                try:
+                    alive = queue.heartbeat(worker, job['id'])
+                except sqlite3.Error as e:
+                    print("[Vmaf-Calculator] Warning: heartbeat of job", job['id'], "failed, retrying |", e, flush=True)
+                    interval = min(poll, heartbeatInterval)
+                    continue
+                interval = heartbeatInterval
+                if not alive:
+                    jobCancel.cancel()
+
+        beatThread = threading.Thread(target=beat, daemon=True)
+        beatThread.start()
+        try:
+            result = handler(job, jobCancel)
+            queue.complete(job['id'], worker, result)
+        except Cancelled:
+            if cancel != None and cancel.isCancelled():
+                queue.release(job['id'], worker)
+        except Exception as e:
+            print("[Vmaf-Calculator] ERROR: job", job['id'], "|", e, flush=True)
+            queue.fail(job['id'], worker, f'{type(e).__name__}: {e}')
+        except BaseException:
+            jobCancel.cancel()
+            queue.release(job['id'], worker)
+            raise
+        finally:
+            stop.set()
+            beatThread.join()
+            if cancel != None:
+                cancel.removeChild(jobCancel)
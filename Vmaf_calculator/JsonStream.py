@@ -0,0 +1,108 @@
+import json
+import re
+
+
+READ_SIZE = 64 * 1024
+WHITESPACE = re.compile(r'\s*')
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*$')
+
+
+class JsonStreamReader:
+    '''
+    Incremental reader of a json document whose top level is an object, as the ones written by ffprobe and libvmaf.
+    The document is read in chunks from a text file object.
+
+    Inputs:
+        - fileobj: text file object (file, pipe) with the json document
+        - callbacks: {key: function}. The items of the top level arrays with these keys are passed one by one
+                     to the function and they are not kept in memory. Items must be objects, arrays or strings.
+    Outputs:
+        - read(): dict with the other top level keys, fully parsed
+    '''
+
+    def __init__(self, fileobj, callbacks=None):
+        self.fileobj = fileobj
+        self.callbacks = callbacks or {}
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    ''' private methods '''
+
+    def _fill(self):
+        """read one more chunk. It returns False at the end of the file"""
+        if self.eof:
+            return False
+        chunk = self.fileobj.read(READ_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """next non whitespace character, without consuming it"""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of json document')
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f'Expected {char!r} at json position {self.pos}')
+        self.pos = self.pos + 1
+
+    def _value(self):
+        """
+        next complete json value. A value followed only by number characters up to the end of the buffer may be
+        a number cut by the chunk (i.e., '123.' of '123.456'): it is decoded again with the next chunk
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            if NUMBER_TAIL.match(self.buffer, end) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _streamArray(self, callback):
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos = self.pos + 1
+            return
+        while True:
+            callback(self._value())
+            if self._peek() == ',':
+                self.pos = self.pos + 1
+                continue
+            self._expect(']')
+            return
+
+    ''' public methods '''
+
+    def read(self):
+        document = {}
+        self._expect('{')
+        if self._peek() == '}':
+            return document
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key in self.callbacks and self._peek() == '[':
+                self._streamArray(self.callbacks[key])
+            else:
+                document[key] = self._value()
+            if self._peek() == ',':
+                self.pos = self.pos + 1
+                continue
+            self._expect('}')
+            return document
@@ -0,0 +1,141 @@
+import re
+import threading
+import time
+
+
+PROGRESS_INTERVAL = 0.5
+STATS_PATTERN = re.compile(r'frame=\s*(\d+)\s+fps=\s*([\d.]+)')
+READ_SIZE = 4096
+
+
+class ProgressReporter:
+    '''
+    Throttled progress of one stage of an analysis (i.e., sync, ssim, vmaf).
+    callback(stage, percent, frame, fps, eta) is called at most once every 'interval' seconds, and always by finish().
+        - percent: 0-100, frame: frames done, fps: processing speed in frames per second, eta: seconds left (None if unknown)
+
+    Inputs:
+        - callback: function, or None to report nothing
+        - stage: name of the stage
+        - totalFrames: expected number of frames of the stage (0 if unknown)
+    '''
+
+    def __init__(self, callback, stage, totalFrames=0, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.stage = stage
+        self.totalFrames = totalFrames
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last = None
+        self.frame = 0
+        self.fps = 0
+
+    def _report(self, percent, eta):
+        self.last = time.monotonic()
+        self.callback(self.stage, percent, self.frame, self.fps, eta)
+
+    def update(self, frame, fps=None):
+        """frames done so far. Without fps, the speed is measured from the start of the stage"""
+        if self.callback == None:
+            return
+        self.frame = frame
+        now = time.monotonic()
+        if fps == None:
+            elapsed = now - self.start
+            fps = frame / elapsed if elapsed > 0 else 0
+        self.fps = fps
+        if self.last != None and now - self.last < self.interval:
+            return
+        percent = 0
+        eta = None
+        if self.totalFrames > 0:
+            percent = min(100, 100 * frame / self.totalFrames)
+            if fps > 0:
+                eta = max(0, (self.totalFrames - frame) / fps)
+        self._report(percent, eta)
+
+    def finish(self):
+        if self.callback == None:
+            return
+        self._report(100, 0)
+
+
+class PartsReporter:
+    '''
+    Progress of a stage run as several concurrent parts (i.e., the segments of a segmented VMAF run).
+    Each part (getPart) is updated as a ProgressReporter and the reporter of the stage gets the sum of the frames
+    and fps of all of them. Parts do not finish the stage: call reporter.finish() once all of them end.
+    '''
+
+    def __init__(self, reporter, parts):
+        self.reporter = reporter
+        self.frames = [0] * parts
+        self.fps = [0] * parts
+        self.lock = threading.Lock()
+
+    def getPart(self, index):
+        return _Part(self, index)
+
+    def update(self, index, frame, fps=None):
+        with self.lock:
+            self.frames[index] = frame
+            self.fps[index] = fps or 0
+            self.reporter.update(sum(self.frames), sum(self.fps) if fps != None else None)
+
+
+class PhasesReporter:
+    '''
+    Progress of a stage run as consecutive phases (i.e., the decode of the sync window, then the scoring of offsets).
+    Each phase (getPhase) is updated as a ProgressReporter with its own frames, counted after the ones of the phases
+    before it, so the reporter of the stage gets the sum of 'totals' as its totalFrames. Phases do not finish the stage.
+    '''
+
+    def __init__(self, reporter, totals):
+        self.reporter = reporter
+        self.totals = totals
+        reporter.totalFrames = sum(totals)
+
+    def getPhase(self, index):
+        return _Phase(self.reporter, sum(self.totals[:index]))
+
+
+class _Phase:
+    def __init__(self, reporter, start):
+        self.reporter = reporter
+        self.start = start
+
+    def update(self, frame, fps=None):
+        self.reporter.update(self.start + frame, fps)
+
+    def finish(self):
+        pass
+
+
+class _Part:
+    def __init__(self, parts, index):
+        self.parts = parts
+        self.index = index
+
+    def update(self, frame, fps=None):
+        self.parts.update(self.index, frame, fps)
+
+    def finish(self):
+        pass
+
+
+def readFFmpegStats(stream, reporter):
+    """
+    It reads the -stats output of ffmpeg (stderr, as bytes) until its end and updates the reporter with its frame and fps.
+    Stats lines end with carriage returns, so the stream is read in chunks instead of lines.
+    """
+    pending = b''
+    while True:
+        chunk = stream.read1(READ_SIZE) if hasattr(stream, 'read1') else stream.read(READ_SIZE)
+        if not chunk:
+            break
+        lines = re.split(rb'[\r\n]', pending + chunk)
+        pending = lines.pop()
+        for line in lines:
+            match = STATS_PATTERN.search(line.decode('utf-8', 'replace'))
+            if match:
+                reporter.update(int(match.group(1)), float(match.group(2)))
@@ -0,0 +1,180 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import numpy as np
+from contextlib import closing
+from Cache import DiskCache, getContentIdentity
+
+
+""" entries of older schemas are keyed by a partial content hash, that can be shared by different files: dropped """
+SCHEMA_VERSION = 2
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS vmaf (
+        key TEXT PRIMARY KEY, distorted TEXT, reference TEXT, model TEXT, graph TEXT,
+        vmaf_path TEXT, cambi_heatmap_path TEXT, created REAL, accessed REAL, outputs TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS sync (
+        key TEXT PRIMARY KEY, distorted TEXT, reference TEXT, sync_offset REAL, psnr REAL, created REAL)''',
+    '''CREATE TABLE IF NOT EXISTS hashes (
+        path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, identity TEXT)''',
+]
+
+
+def _getOutputIdentity(path):
+    """size and mtime of an output file of a run, None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class ResultsStore:
+    '''
+    Local store of analysis results, so an identical analysis is computed only once.
+    Entries are keyed by the content of the inputs (see Cache.getContentIdentity) and everything that changes the
+    scores: the filter graph of the VMAF run (FFmpegQos.getGraph) or the sync options.
+    Rows are kept in a SQLite database (results.db) and the per frame arrays of each VMAF entry in a .npz file.
+    Content hashes are memoized by path, size and mtime, so each input is read in full only once. Threads of a process
+    (i.e., -jobs) that need the hash of the same input wait for the one computing it.
+    The schema is created, or upgraded, once per process in an immediate transaction, so concurrent processes do not
+    race on it.
+
+    Inputs:
+        - path: store directory. It is created if needed
+    Outputs:
+        - getKey(kind, paths, ...): key of a result
+        - getVmaf(key) / putVmaf(): per frame arrays of a VMAF run
+        - getSync(key) / putSync(): offset and psnr of a sync lookup
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.dbPath = os.path.join(path, 'results.db')
+        self.lock = threading.Lock()
+        self.ready = False
+        """ content identities computed by this process: {path: [size, mtime, identity]}, and a lock per path """
+        self.identities = {}
+        self.pathLocks = {}
+
+    ''' private methods '''
+
+    def _migrate(self, db):
+        """It creates the tables, dropping the ones of older schemas, in a transaction that other processes wait for"""
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            dropped = db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION
+            if dropped:
+                for table in ['vmaf', 'sync', 'hashes']:
+                    db.execute(f'DROP TABLE IF EXISTS {table}')
+                db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            for statement in SCHEMA:
+                db.execute(statement)
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        if dropped:
+            for name in os.listdir(self.path):
+                if name.endswith('.npz'):
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except OSError:
+                        pass
+
+    def _connect(self):
+        os.makedirs(self.path, exist_ok=True)
+        db = sqlite3.connect(self.dbPath, timeout=30)
+        if not self.ready:
+            with self.lock:
+                if not self.ready:
+                    try:
+                        self._migrate(db)
+                    except BaseException:
+                        db.close()
+                        raise
+                    self.ready = True
+        return db
+
+    def _framesPath(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def _getContentIdentity(self, path):
+        """
+        Cache.getContentIdentity of path, computed again only if the file changed (size or mtime). It is looked up in
+        this process first, then in the database. A path is hashed by one thread at a time.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            pathLock = self.pathLocks.setdefault(path, threading.Lock())
+        with pathLock:
+            stat = os.stat(path)
+            memo = self.identities.get(path)
+            if memo != None and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+                return memo[2]
+            with closing(self._connect()) as db:
+                row = db.execute('SELECT size, mtime, identity FROM hashes WHERE path = ?', (path,)).fetchone()
+            if row != None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+                identity = json.loads(row[2])
+            else:
+                identity = getContentIdentity(path)
+                with closing(self._connect()) as db, db:
+                    db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+                               (path, stat.st_size, stat.st_mtime_ns, json.dumps(identity)))
+            self.identities[path] = [stat.st_size, stat.st_mtime_ns, identity]
+            return identity
+
+    ''' public methods '''
+
+    def getKey(self, kind, paths, *parts):
+        """key of a result of 'kind' computed from the files in paths. parts: json serializable options"""
+        return DiskCache.getKey(kind, [self._getContentIdentity(path) for path in paths], parts)
+
+    def getVmaf(self, key):
+        """
+        It returns the entry saved with key as a dict with the per frame arrays ('frames'), 'vmaf_path' and
+        'cambi_heatmap_path', or None if it is not in the store. Output paths are None unless the files are still the
+        ones written by the run (same size and mtime): later runs write their logs at the same paths.
+        """
+        with closing(self._connect()) as db, db:
+            row = db.execute('SELECT vmaf_path, cambi_heatmap_path, outputs FROM vmaf WHERE key = ?', (key,)).fetchone()
+            if row == None:
+                return None
+            try:
+                with np.load(self._framesPath(key)) as data:
+                    frames = {name: data[name] for name in data.files}
+            except (OSError, ValueError):
+                return None
+            db.execute('UPDATE vmaf SET accessed = ? WHERE key = ?', (time.time(), key))
+        outputs = json.loads(row[2])
+        paths = [path if path != None and _getOutputIdentity(path) == identity else None
+                 for path, identity in zip(row[:2], outputs)]
+        return {'frames': frames, 'vmaf_path': paths[0], 'cambi_heatmap_path': paths[1]}
+
+    def putVmaf(self, key, distorted, reference, model, graph, frames, vmafPath=None, cambiHeatmapPath=None):
+        """frames: {metric: array} per frame values. vmafPath, cambiHeatmapPath: outputs of the run, as written by it"""
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **frames)
+        os.replace(tmpPath, self._framesPath(key))
+        outputs = [_getOutputIdentity(vmafPath), _getOutputIdentity(cambiHeatmapPath)]
+        now = time.time()
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT OR REPLACE INTO vmaf VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (key, distorted, reference, model, graph, vmafPath, cambiHeatmapPath, now, now, json.dumps(outputs)))
+
+    def getSync(self, key):
+        """It returns the [offset, psnr] saved with key, or None if it is not in the store"""
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT sync_offset, psnr FROM sync WHERE key = ?', (key,)).fetchone()
+        if row == None:
+            return None
+        return [row[0], row[1]]
+
+    def putSync(self, key, distorted, reference, offset, psnr):
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT OR REPLACE INTO sync VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, distorted, reference, offset, psnr, time.time()))
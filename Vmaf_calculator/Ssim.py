@@ -0,0 +1,206 @@
+import subprocess
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import gaussian_filter1d
+from Sync import getWorkers
+from Cancel import killProcess, waitProcess
+
+
+SSIM_SIGMA = 1.5
+SSIM_TRUNCATE = 3.5
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+SSIM_DATA_RANGE = 255
+SSIM_BATCH = 16
+""" memory of a standalone SSIM pass: float32 buffers of every worker and the batches in flight (see getSsimPlan) """
+SSIM_MEMORY = 1024 * 1024 * 1024
+SSIM_BUFFERS = 8
+
+""" preallocated float32 buffers of each thread, reused while the batch shape does not change. Analyses run in threads
+of the same process (i.e., -jobs or the GUI) never share them """
+_local = threading.local()
+
+
+def _getBuffers(shape):
+    buffers = getattr(_local, 'buffers', None)
+    if buffers == None or buffers[0].shape != shape:
+        _local.buffers = None
+        buffers = _local.buffers = [np.empty(shape, dtype=np.float32) for i in range(SSIM_BUFFERS)]
+    return buffers
+
+
+def freeBuffers():
+    """It releases the buffers of the current thread"""
+    _local.buffers = None
+
+
+def getSsimPlan(width, height, workers=0, memory=SSIM_MEMORY, batchSize=SSIM_BATCH):
+    """
+    [workers, batchSize] of a pass over width x height frames that fits in 'memory' bytes. Each frame of a batch
+    takes SSIM_BUFFERS float32 planes in its worker and, while in flight (2 batches per worker), 2 uint8 planes.
+    workers (0: one per cpu) and batchSize are upper bounds: there are never less than 1 worker of 1 frame.
+    """
+    frameMemory = width * height * (SSIM_BUFFERS * 4 + 2 * 2)
+    frames = max(1, memory // frameMemory)
+    workers = max(1, min(getWorkers(workers), frames))
+    return [workers, max(1, min(batchSize, frames // workers))]
+
+
+def _blur(src, dst, tmp):
+    """separable gaussian filter over the height and width of a batch of frames"""
+    gaussian_filter1d(src, SSIM_SIGMA, axis=1, output=tmp, mode='reflect', truncate=SSIM_TRUNCATE)
+    gaussian_filter1d(tmp, SSIM_SIGMA, axis=2, output=dst, mode='reflect', truncate=SSIM_TRUNCATE)
+
+
+def getSsimBatch(mainFrames, refFrames):
+    """
+    SSIM (Wang et al., 11x11 gaussian window, sigma=1.5) of each pair of frames of two batches of 8 bit luma frames
+    with shape (frames, height, width). All the frames of the batch are filtered at once in preallocated
+    buffers and only the mean of each SSIM map is returned. As skimage, borders of the map are not pooled.
+    """
+    x, y, muX, muY, sigmaXX, sigmaYY, sigmaXY, tmp = _getBuffers(mainFrames.shape)
+    c1 = (SSIM_K1 * SSIM_DATA_RANGE) ** 2
+    c2 = (SSIM_K2 * SSIM_DATA_RANGE) ** 2
+
+    np.copyto(x, mainFrames, casting='unsafe')
+    np.copyto(y, refFrames, casting='unsafe')
+    _blur(x, muX, tmp)
+    _blur(y, muY, tmp)
+
+    """ local variances and covariance: E[xy] - E[x]E[y] """
+    np.multiply(x, y, out=sigmaXY)
+    _blur(sigmaXY, sigmaXY, tmp)
+    np.multiply(x, x, out=x)
+    _blur(x, sigmaXX, tmp)
+    np.multiply(y, y, out=y)
+    _blur(y, sigmaYY, tmp)
+    np.multiply(muX, muY, out=x)
+    sigmaXY -= x
+    np.multiply(muX, muX, out=y)
+    sigmaXX -= y
+    np.multiply(muY, muY, out=tmp)
+    sigmaYY -= tmp
+
+    """ ssim map = (2 muX muY + c1)(2 sigmaXY + c2) / ((muX^2 + muY^2 + c1)(sigmaXX + sigmaYY + c2)) """
+    y += tmp
+    y += c1
+    sigmaXX += sigmaYY
+    sigmaXX += c2
+    y *= sigmaXX
+    x *= 2
+    x += c1
+    sigmaXY *= 2
+    sigmaXY += c2
+    x *= sigmaXY
+    x /= y
+
+    pad = int(SSIM_TRUNCATE * SSIM_SIGMA + 0.5)
+    return x[:, pad:-pad, pad:-pad].mean(axis=(1, 2), dtype=np.float64)
+
+
+class SsimEngine:
+    '''
+    Class to compute SSIM over a stream of batches of luma frames.
+    Batches are scored by a pool of 'workers' processes (0: one per cpu, 1: in this process).
+    At most 2 batches per worker are in flight, so memory stays bounded (see getSsimPlan). Scores are returned in
+    frame order. Buffers of this thread are released once the run ends.
+    '''
+
+    def __init__(self, workers=1):
+        self.workers = getWorkers(workers)
+
+    def run(self, batches, reporter=None, cancel=None):
+        """
+        batches: iterable of (mainFrames, refFrames) uint8 arrays with shape (frames, height, width)
+        reporter: ProgressReporter updated with the number of frames scored
+        cancel: CancelToken checked before scoring each batch. Once cancelled, queued batches are dropped
+        It returns the SSIM score of each frame as a float64 array.
+        """
+        scores = []
+        frames = 0
+
+        def add(batchScores):
+            nonlocal frames
+            scores.append(batchScores)
+            frames = frames + len(batchScores)
+            if reporter != None:
+                reporter.update(frames)
+
+        def check():
+            if cancel != None:
+                cancel.check()
+
+        if self.workers == 1:
+            try:
+                for mainFrames, refFrames in batches:
+                    check()
+                    add(getSsimBatch(mainFrames, refFrames))
+            finally:
+                freeBuffers()
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                pending = deque()
+                try:
+                    for mainFrames, refFrames in batches:
+                        check()
+                        pending.append(pool.submit(getSsimBatch, mainFrames, refFrames))
+                        if len(pending) >= 2 * self.workers:
+                            add(pending.popleft().result())
+                    while pending:
+                        check()
+                        add(pending.popleft().result())
+                except BaseException:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    raise
+        if not scores:
+            return np.zeros(0)
+        return np.concatenate(scores)
+
+
+def readLumaBatches(stream, width, height, batchSize=SSIM_BATCH):
+    """
+    It reads frames of MAIN stacked over REF (see FFmpegQos.getLumaPipe) from a binary stream and yields
+    them as (mainFrames, refFrames) batches of, at most, batchSize frames.
+    """
+    frameSize = 2 * width * height
+    while True:
+        batch = np.empty((batchSize, 2 * height, width), dtype=np.uint8)
+        view = memoryview(batch).cast('B')
+        read = 0
+        while read < batchSize * frameSize:
+            n = stream.readinto(view[read:])
+            if not n:
+                break
+            read = read + n
+        frames = read // frameSize
+        if frames:
+            yield batch[:frames, :height], batch[:frames, height:]
+        if frames < batchSize:
+            return
+
+
+def getSsim(ffmpegQos, width, height, subsample=1, workers=1, memory=SSIM_MEMORY, algo='bicubic', reporter=None):
+    """
+    SSIM of each frame of MAIN vs REF, after their filter chains, scaled to width x height.
+    Only one every 'subsample' frames is scaled, piped and scored, as libvmaf n_subsample.
+    workers (0: one per cpu) and the frames of each batch are limited so that the pass fits in 'memory' bytes.
+    reporter: ProgressReporter updated with the number of frames scored
+    If ffmpegQos is cancelled, ffmpeg is killed and Cancelled is raised before scoring the next batch.
+    If ffmpeg fails (i.e., an invalid filter graph), CalledProcessError is raised instead of returning partial scores.
+    """
+    workers, batchSize = getSsimPlan(width, height, workers, memory)
+    process = ffmpegQos.getLumaPipe(width, height, subsample, algo)
+    try:
+        scores = SsimEngine(workers).run(readLumaBatches(process.stdout, width, height, batchSize), reporter,
+                                         ffmpegQos.cancel)
+    except BaseException:
+        killProcess(process)
+        raise
+    finally:
+        process.stdout.close()
+        returncode = waitProcess(process, ffmpegQos.cancel)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, ffmpegQos.cmd)
+    return scores
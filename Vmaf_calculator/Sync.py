@@ -0,0 +1,76 @@
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+PSNR_PEAK = 255.0
+
+
+def getPsnr(mainFrames, refFrames):
+    """
+    PSNR [dB] between two stacks of 8 bit luma frames. As ffmpeg psnr 'average', it is computed
+    from the mean squared error of all the frames compared. Identical frames return inf.
+    """
+    frames = min(len(mainFrames), len(refFrames))
+    if frames == 0:
+        return 0.0
+    diff = mainFrames[:frames].astype(np.float32) - refFrames[:frames].astype(np.float32)
+    mse = float(np.mean(diff * diff))
+    if mse == 0:
+        return float('inf')
+    return float(10 * np.log10(PSNR_PEAK * PSNR_PEAK / mse))
+
+
+def getPsnrCurve(mainFrames, refFrames, offsets, workers=1, reporter=None, cancel=None):
+    """
+    It scores every candidate offset against in-memory frames: for the offset i, the MAIN probe clip
+    is compared with the REF frames starting at index i.
+    It returns the list of PSNR values in the same order as offsets.
+
+    With workers > 1 (0: one per cpu), offsets are scored concurrently by a bounded pool of threads.
+    numpy releases the GIL while scoring and the threads share the decoded frames without copies.
+    Results are collected in order, so the output is the same as the serial path.
+    reporter: ProgressReporter updated with the number of offsets scored
+    cancel: CancelToken checked before scoring each offset
+    """
+    probeFrames = len(mainFrames)
+    workers = getWorkers(workers)
+
+    def score(i):
+        if cancel != None:
+            cancel.check()
+        return getPsnr(mainFrames, refFrames[i:i + probeFrames])
+
+    if workers == 1:
+        return _collect(map(score, offsets), reporter)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return _collect(pool.map(score, offsets), reporter)
+
+
+def _collect(values, reporter=None):
+    """list of values of an iterator, reporting how many are done"""
+    result = []
+    for value in values:
+        result.append(value)
+        if reporter != None:
+            reporter.update(len(result))
+    return result
+
+
+def getWorkers(workers):
+    """
+    Number of workers of a pool: 0 means one per cpu.
+    """
+    if workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+
+def getPeaks(values, count):
+    """
+    It returns the indexes of, at most, 'count' local maxima of values, sorted from the highest to the lowest
+    """
+    peaks = [i for i in range(len(values))
+             if (i == 0 or values[i] >= values[i - 1]) and (i == len(values) - 1 or values[i] > values[i + 1])]
+    peaks.sort(key=lambda i: values[i], reverse=True)
+    return peaks[:count]
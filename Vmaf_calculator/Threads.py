@@ -0,0 +1,33 @@
+import os
+
+
+class ThreadPlan:
+    '''
+    Threads of each stage of a VMAF run. None: the ffmpeg default (the decoder and filter graph choose their own)
+        - mainDecode, refDecode: decoder of MAIN and REF (-threads of each input)
+        - filter: slice threading of the filters of the graph (-filter_complex_threads): scale, yadif, hqdn3d...
+        - vmaf: libvmaf feature extraction (n_threads)
+    '''
+
+    def __init__(self, mainDecode, refDecode, filter, vmaf):
+        self.mainDecode = mainDecode
+        self.refDecode = refDecode
+        self.filter = filter
+        self.vmaf = vmaf
+
+    def __str__(self):
+        def text(threads):
+            return 'auto' if threads == None else str(threads)
+        return f'decode {text(self.mainDecode)} (Distorted) {text(self.refDecode)} (Reference) | filters {text(self.filter)} | libvmaf {text(self.vmaf)}'
+
+
+def getThreadPlan(budget, decode=0, filter=0, vmaf=0):
+    """
+    Threads of the stages of a VMAF run (see ThreadPlan): decode (for each input), filter and vmaf, if given (> 0).
+    Otherwise decoders and filters keep the ffmpeg default and libvmaf gets the whole 'budget' (0: one per cpu).
+    The budget is not split between the stages by default: no split has been measured to be faster on every host.
+    """
+    if budget <= 0:
+        budget = os.cpu_count()
+    return ThreadPlan(decode if decode > 0 else None, decode if decode > 0 else None,
+                      filter if filter > 0 else None, vmaf if vmaf > 0 else budget)
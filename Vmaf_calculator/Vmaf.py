@@ -1,17 +1,44 @@
 
 from FFmpeg import FFprobe
+from FFmpeg import FFmpegPreprocess
 from FFmpeg import FFmpegQos
+from FFmpeg import FFmpegQosLadder
+from FFmpeg import SSIM_FEATURE_NAME, MS_SSIM_FEATURE_NAME
+from Sync import getPsnrCurve, getPeaks, getWorkers
+from Ssim import getSsim
+from Progress import ProgressReporter, PartsReporter, PhasesReporter
+from Cancel import CancelToken, killAll
+from VmafLog import mergeVmafLogs
+from Threads import getThreadPlan
+from concurrent.futures import ThreadPoolExecutor
+import math
 import os
 
 
+MODEL_RESOLUTIONS = {'HD': [1920, 1080], '4K': [3840, 2160]}
+
+SYNC_PROBE_DURATION = 0.5
+SYNC_RESOLUTION = [640, 360]
+
+SYNC_LINEAR_MAX_WINDOW = 5
+SYNC_COARSE_RATE = 5
+SYNC_COARSE_PROBE_DURATION = 2
+SYNC_COARSE_RESOLUTION = [160, 90]
+SYNC_COARSE_CANDIDATES = 3
+SYNC_MARGIN = 3
+
+SEGMENT_SEEK_MARGIN = 0.25
+
+
 class video():
     """
     Video class to parse information of video streams obtained
     by _FFmpeg.FFprobe
     """
 
-    def __init__(self, videoSrc, loglevel="info"):
+    def __init__(self, videoSrc, loglevel="info", probe_depth='head', cancel=None):
         self.videoSrc = videoSrc
+        self.cancel = cancel
         self.streamInfo = None
         self.framesInfo = None
         self.packetsInfo = None
@@ -21,24 +48,17 @@ class video():
         self.bytesFramesTotal = None
         self.interlaced = None
         self.loglevel = loglevel
-        self.getStreamInfo()
-        self.getFormatInfo()
-        self.getFramesInfo()
+        self.probe_depth = probe_depth
+        self.getInfo()
         self.duration = self.getDuration()
 
     def _updateFramesSummary(self):
-        interlacedFrames_count = 0
-        bytesFramesTotal = 0
         if self.framesInfo == None:
             return
-        for frame in self.framesInfo:
-            interlacedFrames_count = interlacedFrames_count + \
-                int(frame['interlaced_frame'])
-            bytesFramesTotal = bytesFramesTotal + int(frame['pkt_size'])
-        self.interlacedFrames = interlacedFrames_count
+        self.interlacedFrames = self.framesInfo.interlacedFrames
         self.totalFrames = len(self.framesInfo)
-        self.bytesFramesTotal = bytesFramesTotal
-        if int(round(self.interlacedFrames/self.totalFrames)):
+        self.bytesFramesTotal = self.framesInfo.bytesFramesTotal
+        if self.totalFrames and int(round(self.interlacedFrames/self.totalFrames)):
             self.interlaced = True
         else:
             self.interlaced = False
@@ -57,19 +77,36 @@ class video():
                 duration = round(float(self.formatInfo['duration']))
         return duration
 
+    def getResolution(self):
+        """[width, height] of the video stream"""
+        return [self.streamInfo['width'], self.streamInfo['height']]
+
+    def getInfo(self):
+        """
+        Stream, format and frames info obtained from a single FFprobe run
+        """
+        print("\n\n=======================================", flush=True)
+        print("[Vmaf-Calculator] Getting stream, format and frames info...", self.videoSrc, flush=True)
+        print("=======================================", flush=True)
+        self.streamInfo, self.formatInfo, self.framesInfo = FFprobe(
+            self.videoSrc, self.loglevel, self.probe_depth, cancel=self.cancel).getInfo()
+        print (self.formatInfo)
+        self._updateFramesSummary()
+        return self.streamInfo, self.formatInfo, self.framesInfo
+
     def getStreamInfo(self):
         print("\n\n=======================================", flush=True)
         print("[Vmaf-Calculator] Getting stream info...", self.videoSrc, flush=True)
         print("=======================================", flush=True)
 
-        self.streamInfo = FFprobe(self.videoSrc, self.loglevel).getStreamInfo()
+        self.streamInfo = FFprobe(self.videoSrc, self.loglevel, cancel=self.cancel).getStreamInfo()
         return self.streamInfo
 
     def getFramesInfo(self):
         print("\n\n=======================================", flush=True)
         print("[Vmaf-Calculator] Getting frames info...", self.videoSrc, flush=True)
         print("=======================================", flush=True)
-        self.framesInfo = FFprobe(self.videoSrc, self.loglevel).getFramesInfo()
+        self.framesInfo = FFprobe(self.videoSrc, self.loglevel, self.probe_depth, cancel=self.cancel).getFramesInfo()
         self._updateFramesSummary()
         return self.framesInfo
 
@@ -78,14 +115,14 @@ class video():
         print("[Vmaf-Calculator] Getting packets info...", self.videoSrc, flush=True)
         print("=======================================", flush=True)
         self.packetsInfo = FFprobe(
-            self.videoSrc, self.loglevel).getPacketsInfo()
+            self.videoSrc, self.loglevel, self.probe_depth, cancel=self.cancel).getPacketsInfo()
         return self.packetsInfo
 
     def getFormatInfo(self):
         print("\n\n=======================================", flush=True)
         print("[Vmaf-Calculator] Getting format info...", self.videoSrc, flush=True)
         print("=======================================", flush=True)
-        self.formatInfo = FFprobe(self.videoSrc, self.loglevel).getFormatInfo()
+        self.formatInfo = FFprobe(self.videoSrc, self.loglevel, cancel=self.cancel).getFormatInfo()
         print (self.formatInfo)
         return self.formatInfo
 
@@ -97,17 +134,31 @@ class vmaf():
         - Deinterlace automatically the MAIN and REF videos if needed
         - To SYNC (in time) the MAIN and REF videos using psnr computation 
         - Frame rate conversion (if needed)
+        - Denoise and brightness adjustment of the MAIN video, in the same filter graph or, with preprocess_cache,
+          in a lossless copy kept in the preprocessing cache
+        - VMAF of long videos in 'segments' ffmpeg runs at the same time, split on keyframes of MAIN (see runVmaf)
+        - Threads of the decoders, filters and libvmaf (see Threads.getThreadPlan): decode_threads, filter_threads
+          and vmaf_threads (0: ffmpeg default for decoders and filters, all the threads for libvmaf)
+    Every ffprobe/ffmpeg run and worker pool is stopped by 'cancel' (Cancel.CancelToken): steps then raise Cancelled.
     """
 
-    def __init__(self, mainSrc, refSrc, output_fmt, model="HD", phone=False, loglevel="info", subsample=1, threads=0, print_progress=False, end_sync=False,  manual_fps=0, cambi_heatmap=False):
+    def __init__(self, mainSrc, refSrc, output_fmt, model="HD", phone=False, loglevel="info", subsample=1, threads=0, print_progress=False, end_sync=False,  manual_fps=0, cambi_heatmap=False, sync_workers=1, probe_depth='head', denoise=False, brightness=1.0, preprocess_cache=None, progress=None, cancel=None, segments=1, decode_threads=0, filter_threads=0, vmaf_threads=0):
         self.loglevel = loglevel
-        self.main = video(mainSrc, self.loglevel)
-        self.ref = video(refSrc, self.loglevel)
+        self.progress = progress
+        self.cancel = cancel
+        self.denoise = denoise
+        self.brightness = brightness
+        self.mainSrc = mainSrc
+        if preprocess_cache:
+            mainSrc = self._writePreprocessed(mainSrc, preprocess_cache)
+        self.main = video(mainSrc, self.loglevel, probe_depth, cancel)
+        self.ref = video(refSrc, self.loglevel, probe_depth, cancel)
         self.model = model
         self.phone = phone
         self.subsample = subsample
         self.ffmpegQos = FFmpegQos(
-            self.main.videoSrc, self.ref.videoSrc, self.loglevel)
+            self.main.videoSrc, self.ref.videoSrc, self.loglevel, cancel, self.main.getResolution(), self.ref.getResolution(),
+            getFrameRate(self.main.streamInfo['r_frame_rate']), getFrameRate(self.ref.streamInfo['r_frame_rate']))
         self.target_resolution = None
         self.offset = 0
         self.manual_fps = manual_fps
@@ -117,42 +168,67 @@ class vmaf():
         self.print_progress = print_progress
         self.end_sync = end_sync
         self.cambi_heatmap = cambi_heatmap
-
+        self.sync_workers = sync_workers
+        self.segments = segments
+        self.decode_threads = decode_threads
+        self.filter_threads = filter_threads
+        self.vmaf_threads = vmaf_threads
+        self.threadPlan = None
 
     def _initResolutions(self):
         """ 
         initialization of resolutions for each vmaf model
         """
-        if self.model == 'HD':
-            self.target_resolution = [1920, 1080]
-        elif self.model == '4K':
-            self.target_resolution = [3840, 2160]
+        if self.model in MODEL_RESOLUTIONS:
+            self.target_resolution = MODEL_RESOLUTIONS[self.model]
         else:
             exit("[Vmaf-Calculator] ERROR: Invalid vmaf model")
 
     def _autoScale(self):
         """ 
-        scaling MAIN and REF if they dont match with the resolution requiered by the vmaf model (target resolution)
-        """
-        refResolution = [self.ref.streamInfo['width'],
-                         self.ref.streamInfo['height']]
-        mainResolution = [self.main.streamInfo['width'],
-                          self.main.streamInfo['height']]
-        if refResolution != self.target_resolution:
-            if not self.ffmpegQos.invertedSrc:
-                self.ffmpegQos.ref.setScaleFilter(
-                    self.target_resolution[0], self.target_resolution[1])
-            if self.ffmpegQos.invertedSrc:
-                self.ffmpegQos.main.setScaleFilter(
-                    self.target_resolution[0], self.target_resolution[1])
-
-        if mainResolution != self.target_resolution:
-            if not self.ffmpegQos.invertedSrc:
-                self.ffmpegQos.main.setScaleFilter(
-                    self.target_resolution[0], self.target_resolution[1])
-            if self.ffmpegQos.invertedSrc:
-                self.ffmpegQos.ref.setScaleFilter(
-                    self.target_resolution[0], self.target_resolution[1])
+        scaling MAIN and REF if they dont match with the resolution requiered by the vmaf model (target resolution).
+        Chains already at the target resolution (i.e., a REF branch of a ladder) are not scaled again: the resolution
+        of each chain is tracked from the one of its video (see inputFFmpeg.setScaleFilter)
+        """
+        for stream in [self.ffmpegQos.main, self.ffmpegQos.ref]:
+            stream.setScaleFilter(self.target_resolution[0], self.target_resolution[1])
+
+    def _setPreprocessFilters(self, stream):
+        """Brightness adjustment and denoise filters, at the resolution of the stream"""
+        if self.brightness != 1.0:
+            stream.setBrightnessFilter(self.brightness)
+        if self.denoise:
+            stream.setDenoiseFilter()
+
+    def _writePreprocessed(self, mainSrc, codec):
+        """
+        It writes (or reuses) a lossless preprocessed copy of MAIN in the preprocessing cache and returns its path.
+        The filters are not added to the graph anymore.
+        """
+        preprocess = FFmpegPreprocess(mainSrc, self.loglevel, codec, self.cancel)
+        self._setPreprocessFilters(preprocess.input)
+        if not preprocess.input.filtersList:
+            return mainSrc
+        print("\n\n=======================================", flush=True)
+        print("[Vmaf-Calculator] Preprocessing...", mainSrc, "| codec:", codec, flush=True)
+        print("=======================================", flush=True)
+        path = preprocess.getPath()
+        print("Preprocessed copy:", path, flush=True)
+        self.denoise = False
+        self.brightness = 1.0
+        return path
+
+    def _preprocess(self, ffmpegQos=None):
+        """
+        Brightness adjustment and denoise of MAIN, at its own resolution, as filters of its chain:
+        no intermediate file is encoded
+        """
+        if ffmpegQos is None:
+            ffmpegQos = self.ffmpegQos
+        if not ffmpegQos.invertedSrc:
+            self._setPreprocessFilters(ffmpegQos.main)
+        else:
+            self._setPreprocessFilters(ffmpegQos.ref)
 
     def _deinterlaceFrame(self, factor, stream):
         ref_fps = getFrameRate(self.ref.streamInfo['r_frame_rate'])
@@ -171,10 +247,12 @@ class vmaf():
         if round(ref_fps, 2) != round(factor*main_fps, 2):
             stream.setFpsFilter(round(main_fps, 5))
 
-    def _autoDeinterlace(self):
+    def _autoDeinterlace(self, ffmpegQos=None):
         """ 
         This functions normalizes the framerate between MAIN and REF video streams (if needed)
         """
+        if ffmpegQos == None:
+            ffmpegQos = self.ffmpegQos
         ref_fps = getFrameRate(self.ref.streamInfo['r_frame_rate'])
         main_fps = getFrameRate(self.main.streamInfo['r_frame_rate'])
 
@@ -187,22 +265,22 @@ class vmaf():
                 """
                 print(
                     "[Vmaf-Calculator] Warning: Frame rate conversion can produce bad vmaf scores", flush=True)
-                self.ffmpegQos.main.setFpsFilter(round(ref_fps, 5))
+                ffmpegQos.main.setFpsFilter(round(ref_fps, 5))
             elif round(ref_fps) > round(main_fps):
                 """
                 frame rate conversion over REF video. The lowest framerate is choosed (MAIN fps).
                 """
                 print(
                     "[Vmaf-Calculator] Warning: Frame rate conversion can produce bad vmaf scores", flush=True)
-                self.ffmpegQos.ref.setFpsFilter(round(main_fps, 5))
+                ffmpegQos.ref.setFpsFilter(round(main_fps, 5))
             else:
                 """
                 This just pass the original framerate to the ffmpeg filter (lavfi) when no frame rate
                 conversion is requiered. For some reason it is mandatory by lavfi in order to work properly.
                 """
 
-                self.ffmpegQos.main.setFpsFilter(round(main_fps, 5))
-                self.ffmpegQos.ref.setFpsFilter(round(ref_fps, 5))
+                ffmpegQos.main.setFpsFilter(round(main_fps, 5))
+                ffmpegQos.ref.setFpsFilter(round(ref_fps, 5))
 
         elif self.ref.interlaced and not self.main.interlaced:
             """ 
@@ -211,28 +289,28 @@ class vmaf():
             if round(ref_fps) == round(main_fps*2):
                 # Examples: REF=60i, MAIN=30p
                 # REF=59.97i, MAIN=30p, etc
-                if not self.ffmpegQos.invertedSrc:
-                    self._deinterlaceFrame(2, self.ffmpegQos.ref)
+                if not ffmpegQos.invertedSrc:
+                    self._deinterlaceFrame(2, ffmpegQos.ref)
                 else:
-                    self._deinterlaceFrame(2, self.ffmpegQos.main)
+                    self._deinterlaceFrame(2, ffmpegQos.main)
 
             elif round(ref_fps) == round(main_fps):
                 # Examples: 
                 # REF=30i, MAIN=30p
                 # REF=29.97i, MAIN=30p, etc
-                if not self.ffmpegQos.invertedSrc:
-                    self._deinterlaceFrame(1, self.ffmpegQos.ref)
+                if not ffmpegQos.invertedSrc:
+                    self._deinterlaceFrame(1, ffmpegQos.ref)
                 else:
-                    self._deinterlaceFrame(1, self.ffmpegQos.main)
+                    self._deinterlaceFrame(1, ffmpegQos.main)
 
             elif round(ref_fps) == round(main_fps/2):
                 # Examples: 
                 # REF=30i, MAIN=60p
                 # REF=29.97i, MAIN=60p, etc
-                if not self.ffmpegQos.invertedSrc:
-                    self._deinterlaceField(0.5, self.ffmpegQos.ref)
+                if not ffmpegQos.invertedSrc:
+                    self._deinterlaceField(0.5, ffmpegQos.ref)
                 else:
-                    self._deinterlaceField(0.5, self.ffmpegQos.main)
+                    self._deinterlaceField(0.5, ffmpegQos.main)
 
             else:
                 print(
@@ -247,30 +325,114 @@ class vmaf():
                 # REF=60p, MAIN=29.97i, etc
                 print(
                     "[Vmaf-Calculator] Warning: Frame rate conversion can produce bad vmaf scores", flush=True)
-                if not self.ffmpegQos.invertedSrc:
-                    self._deinterlaceField(1, self.ffmpegQos.main)
+                if not ffmpegQos.invertedSrc:
+                    self._deinterlaceField(1, ffmpegQos.main)
                 else:
-                    self._deinterlaceField(1, self.ffmpegQos.ref)
+                    self._deinterlaceField(1, ffmpegQos.ref)
 
             elif round(ref_fps) == round(main_fps):
                 # Examples: 
                 # REF=30p, MAIN=30i
                 # REF=30p, MAIN=29.97i, etc
-                if not self.ffmpegQos.invertedSrc:
-                    self._deinterlaceFrame(1, self.ffmpegQos.main)
+                if not ffmpegQos.invertedSrc:
+                    self._deinterlaceFrame(1, ffmpegQos.main)
                 else:
-                    self._deinterlaceFrame(1, self.ffmpegQos.ref)
+                    self._deinterlaceFrame(1, ffmpegQos.ref)
 
             else:
                 print(
                     "[Vmaf-Calculator] ERROR: No Filters available for the given Framerates", flush=True)
 
-    def _forceFps(self):
+    def _forceFps(self, ffmpegQos=None):
+        if ffmpegQos == None:
+            ffmpegQos = self.ffmpegQos
         print("[Vmaf-Calculator] Warning: Forcing frame rate conversion manually", flush=True)
-        self.ffmpegQos.main.setFpsFilter(self.manual_fps)
-        self.ffmpegQos.main.setFpsFilter(self.manual_fps)
+        ffmpegQos.main.setFpsFilter(self.manual_fps)
+        ffmpegQos.main.setFpsFilter(self.manual_fps)
 
-    def syncOffset(self, syncWindow=3, start=0, reverse=False):
+    def _decodeSyncFrames(self, start, duration, probeDuration, fps, resolution, reporter=None):
+        """
+        It decodes, once, a REF window of 'duration' seconds from 'start' and the first 'probeDuration' seconds
+        of MAIN as luma frames at the given fps and resolution. Frame i of REF is at time start + i/fps.
+        It uses its own FFmpegQos, so several windows can be decoded concurrently.
+        reporter: ProgressReporter updated with the frames of the REF window decoded (about duration * fps)
+        """
+        ffmpegQos = FFmpegQos(self.ffmpegQos.main.videoSrc, self.ffmpegQos.ref.videoSrc, self.loglevel, self.cancel,
+                              self.ffmpegQos.main.sourceResolution, self.ffmpegQos.ref.sourceResolution,
+                              self.ffmpegQos.main.sourceFps, self.ffmpegQos.ref.sourceFps)
+        ffmpegQos.invertedSrc = self.ffmpegQos.invertedSrc
+        ffmpegQos.ref.setTrimFilter(start, duration)
+        ffmpegQos.main.setTrimFilter(0, probeDuration)
+        self._preprocess(ffmpegQos)
+        if self.manual_fps == 0:
+            self._autoDeinterlace(ffmpegQos)
+        else:
+            self._forceFps(ffmpegQos)
+        return ffmpegQos.getLumaFrames(fps, resolution[0], resolution[1], reporter=reporter)
+
+    def _linearSearch(self, startFrame, framesInSyncWindow, fps, reporter=None):
+        """
+        Exhaustive search: every frame offset of the sync window is scored at SYNC_RESOLUTION
+        Progress: the frames of the window decoded, then the offsets scored
+        """
+        psnr = {'value': [], 'time': []}
+        phases = None
+        if reporter != None:
+            phases = PhasesReporter(reporter, [framesInSyncWindow + int(round(SYNC_PROBE_DURATION*fps)), framesInSyncWindow])
+        mainFrames, refFrames = self._decodeSyncFrames(
+            startFrame/fps, framesInSyncWindow/fps + SYNC_PROBE_DURATION, SYNC_PROBE_DURATION, fps, SYNC_RESOLUTION,
+            phases.getPhase(0) if phases != None else None)
+        psnr['value'] = getPsnrCurve(mainFrames, refFrames, range(0, framesInSyncWindow), self.sync_workers,
+                                     phases.getPhase(1) if phases != None else None, self.cancel)
+        for i in range(0, framesInSyncWindow):
+            psnr['time'].append((startFrame + i)/fps)
+        return psnr
+
+    def _hierarchicalSearch(self, startFrame, framesInSyncWindow, fps, margin, reporter=None):
+        """
+        Coarse to fine search:
+            1. Offsets on a grid of 'step' frames are scored on thumbnails (SYNC_COARSE_RESOLUTION). Only one
+               every 'step' frames is decoded from REF and MAIN.
+            2. The best peaks of the coarse curve are refined, frame by frame, at SYNC_RESOLUTION.
+               Peaks more than 'margin' dB below the best one are not refined. The best one always is.
+        Progress: the thumbnails of the window decoded, then the coarse offsets scored. Refinements are not reported.
+        """
+        psnr = {'value': [], 'time': []}
+        step = max(1, int(round(fps/SYNC_COARSE_RATE)))
+        offsets = len(range(0, framesInSyncWindow, step))
+        phases = None
+        if reporter != None:
+            phases = PhasesReporter(reporter, [int(round((framesInSyncWindow/fps + SYNC_COARSE_PROBE_DURATION)*fps/step)), offsets])
+        mainFrames, refFrames = self._decodeSyncFrames(
+            startFrame/fps, framesInSyncWindow/fps + SYNC_COARSE_PROBE_DURATION, SYNC_COARSE_PROBE_DURATION, fps/step, SYNC_COARSE_RESOLUTION,
+            phases.getPhase(0) if phases != None else None)
+        coarse = getPsnrCurve(mainFrames, refFrames, range(0, offsets), self.sync_workers,
+                              phases.getPhase(1) if phases != None else None, self.cancel)
+        peaks = getPeaks(coarse, SYNC_COARSE_CANDIDATES)
+        """ the best peak is always refined. Bit-exact matches (inf dB) are all within the margin of each other """
+        peaks = peaks[:1] + [peak for peak in peaks[1:]
+                             if math.isinf(coarse[peak]) or coarse[peaks[0]] - coarse[peak] < margin]
+        print("coarse search:", len(coarse), "offsets every", step, "frames |", len(peaks), "peaks to refine", flush=True)
+
+        def refine(peak):
+            first = max(0, peak*step - step + 1)
+            last = min(framesInSyncWindow, peak*step + step)
+            mainFrames, refFrames = self._decodeSyncFrames(
+                (startFrame + first)/fps, (last - first)/fps + SYNC_PROBE_DURATION, SYNC_PROBE_DURATION, fps, SYNC_RESOLUTION)
+            return first, last, getPsnrCurve(mainFrames, refFrames, range(0, last - first), cancel=self.cancel)
+
+        """ peaks are decoded and refined concurrently. Each one has its own ffmpeg process """
+        with ThreadPoolExecutor(max_workers=max(1, min(len(peaks), getWorkers(self.sync_workers)))) as pool:
+            for first, last, values in pool.map(refine, peaks):
+                psnr['value'] += values
+                psnr['time'] += [(startFrame + i)/fps for i in range(first, last)]
+
+        order = sorted(range(len(psnr['time'])), key=lambda i: psnr['time'][i])
+        psnr['value'] = [psnr['value'][i] for i in order]
+        psnr['time'] = [psnr['time'][i] for i in order]
+        return psnr
+
+    def syncOffset(self, syncWindow=3, start=0, reverse=False, search='linear', margin=SYNC_MARGIN):
         """
         Method to get the offset needed to sync REF and MAIN (if any). 
             syncWindow -->  Window Size in seconds to try to sync REF and MAIN videos. i.e., if the video to sync
@@ -281,9 +443,19 @@ class vmaf():
             reverse --> If this option is set to TRUE. It is considered that MAIN is delayed in comparition to REF: 'syncWindow' and 'start' variables will be 
                         applied to MAIN.
                         By default, it is supposed that the REF video is delayed in comparition with the MAIN video. 
+            search --> 'linear': every frame offset of the window is scored.
+                       'hierarchical': coarse to fine search with early termination. See _hierarchicalSearch()
+                       'auto': 'hierarchical' for windows longer than SYNC_LINEAR_MAX_WINDOW seconds, 'linear' otherwise.
+            margin --> confidence margin in dB of the hierarchical search.
 
         It returns the offset value to get REF and MAIN synced and the PSNR computed.
         """
+        if search == 'auto':
+            if syncWindow > SYNC_LINEAR_MAX_WINDOW:
+                search = 'hierarchical'
+            else:
+                search = 'linear'
+
         print("Calculating sync offset...")
         print("\n\n=======================================", flush=True)
         print("Syncing... Computing PSNR values... ", flush=True)
@@ -292,8 +464,8 @@ class vmaf():
             self.main.streamInfo['r_frame_rate']), 5), "fps", "|", self.main.streamInfo['width'], self.main.streamInfo['height'], flush=True)
         print("Reference:", self.ref.videoSrc, "@", round(getFrameRate(
             self.ref.streamInfo['r_frame_rate']), 5), "fps", "|", self.ref.streamInfo['width'], self.ref.streamInfo['height'],  flush=True)
+        print("Search:", search, flush=True)
         print("=======================================", flush=True)
-        print("offset(s)", "\t\t", "psnr[dB]", flush=True)
 
         if reverse:
             self.ffmpegQos.invertSrcs()
@@ -301,21 +473,20 @@ class vmaf():
         frameDuration = 1/fps
         startFrame = int(round(start/frameDuration))
         framesInSyncWindow = int(round(syncWindow/frameDuration))
-        psnr = {'value': [], 'time': []}
 
-        for i in range(0, framesInSyncWindow):
-            offset = (startFrame + i) * frameDuration
-            self.ffmpegQos.main.clearFilters()
-            self.ffmpegQos.ref.clearFilters()
-            self.ffmpegQos.ref.setTrimFilter(offset, 0.5)
-            self.ffmpegQos.main.setTrimFilter(0, 0.5)
-            self._autoScale()
-            if self.manual_fps == 0:
-                self._autoDeinterlace()
-            else:
-                self._forceFps()
-            psnr['value'].append(self.ffmpegQos.getPsnr())
-            psnr['time'].append(offset)
+        """
+        REF sync window and MAIN probe clip are decoded only once into downscaled luma frames.
+        Every candidate offset is then scored in memory against them.
+        """
+        reporter = ProgressReporter(self.progress, 'sync')
+        if search == 'hierarchical':
+            psnr = self._hierarchicalSearch(startFrame, framesInSyncWindow, fps, margin, reporter)
+        else:
+            psnr = self._linearSearch(startFrame, framesInSyncWindow, fps, reporter)
+        reporter.finish()
+
+        print("offset(s)", "\t\t", "psnr[dB]", flush=True)
+        for i in range(0, len(psnr['time'])):
             print(psnr['time'][i], "\t", psnr['value'][i], flush=True)
 
         maxPsnr = max(psnr['value'])
@@ -357,14 +528,62 @@ class vmaf():
             self.ffmpegQos.main.setTrimFilter(offset, duration)
             self.ffmpegQos.ref.setTrimFilter(0, duration)
 
-    def getVmaf(self, autoSync=False):
+    def setSegment(self, start, frames, fps=None):
+        """
+        Instead of setOffset(), for a segment of the timeline aligned by the offset: 'frames' frames (at fps) from
+        frame 'start' of the timeline, or up to its end (as setOffset) if frames is None.
+        fps: default, the frame rate of the compared frames (see _getComparedFps): the chains must be set before.
+        MAIN and REF are seeked (input -ss) instead of trimmed from the beginning, so ffmpeg only decodes them from
+        the keyframe before the segment. Seeks are a quarter of a frame early: the first frame is kept whatever the
+        rounding of its timestamp.
+        """
+        if fps == None:
+            fps = self._getComparedFps()
+        position = (start - SEGMENT_SEEK_MARGIN) / fps
+        for stream, streamStart in [(self.ffmpegQos.main, max(0, -self.offset)), (self.ffmpegQos.ref, max(0, self.offset))]:
+            stream.extraOptions = []
+            if streamStart + position > 0:
+                stream.extraOptions = ['-ss', f'{streamStart + position:.6f}']
+
+        if frames != None:
+            duration = frames / fps
+        elif self.offset != 0:
+            duration = min(self.main.duration - max(0, -self.offset), self.ref.duration - max(0, self.offset)) - start / fps
+        else:
+            return
+        self.ffmpegQos.main.setTrimFilter(0, duration)
+        self.ffmpegQos.ref.setTrimFilter(0, duration)
+
+    def _getComparedFps(self):
+        """
+        frame rate of the compared frames: the output of the MAIN and REF chains (see FFmpegQos.getComparedFps), i.e.,
+        twice the rate of an interlaced video deinterlaced one frame per field. The filters must be set before
+        (see _setFilters), otherwise it is the lowest frame rate of the videos.
+        """
+        if self.manual_fps != 0:
+            return self.manual_fps
+        return self.ffmpegQos.getComparedFps()
+
+    def getComparedFrames(self, subsample=1):
+        """expected number of frames compared after the offset (one every 'subsample'), at the rate of the chains set"""
+        duration = min(self.main.duration - max(0, -self.offset), self.ref.duration - max(0, self.offset))
+        return max(0, int(duration * self._getComparedFps() + subsample - 1) // subsample)
+
+    def _setFilters(self, autoSync=False, segment=None, scale=True):
+        """
+        Filter chains shared by every metric: scaling, deinterlacing/frame rate conversion and offset
+        segment: [start, frames] to set the filters of a segment (see setSegment) instead of the offset
+        scale: False to leave the chains at the resolution of the videos, for passes that scale their own output
+        """
         """ clean all filters first """
         self.ffmpegQos.clearFilters()
         self.ffmpegQos.main.clearFilters()
         self.ffmpegQos.ref.clearFilters()
 
-        """AutoScale according to vmaf model and deinterlace the source if needed """
-        self._autoScale()
+        """Denoise/brightness of MAIN, then AutoScale according to vmaf model and deinterlace the source if needed """
+        self._preprocess()
+        if scale:
+            self._autoScale()
 
         if self.manual_fps == 0:
             self._autoDeinterlace()
@@ -377,11 +596,32 @@ class vmaf():
         if autoSync:
             self.syncOffset()
         """Apply Offset filters, if offset =0 nothing happens """
-        self.setOffset()
-
-        self.features = f'name=psnr|name=cambi\\\\:full_ref=true\\\\:enc_width={self.main.streamInfo["width"]}\\\\:enc_height={self.main.streamInfo["height"]}\\\\:src_width={self.ref.streamInfo["width"]}\\\\:src_height={self.ref.streamInfo["height"]}'
+        if segment == None:
+            self.setOffset()
+        else:
+            self.setSegment(*segment)
 
+    def getSsim(self, workers=0):
+        """
+        Standalone SSIM pass, for when it can not be read from libvmaf. It uses the same alignment (offset),
+        scaling, deinterlacing and subsampling as getVmaf(): frames skipped by subsample are never scaled or scored.
+        Chains are scaled to the target resolution once, at the end, after subsampling (see FFmpegQos.getLumaPipe).
+        It returns the SSIM score of each compared frame.
+        """
+        self._setFilters(scale=False)
+        print("\n\n=======================================", flush=True)
+        print("Computing SSIM... ", flush=True)
+        print("=======================================", flush=True)
+        print("Offset:", self.offset, flush=True)
+        print("subsample:", self.subsample, flush=True)
+        print("=======================================", flush=True)
+        reporter = ProgressReporter(self.progress, 'ssim', self.getComparedFrames(self.subsample))
+        scores = getSsim(self.ffmpegQos, self.target_resolution[0], self.target_resolution[1], self.subsample, workers,
+                         reporter=reporter)
+        reporter.finish()
+        return scores
 
+    def _printVmafInfo(self):
         print("\n\n=======================================", flush=True)
         print("Computing VMAF... ", flush=True)
         print("=======================================", flush=True)
@@ -395,13 +635,216 @@ class vmaf():
         print("loglevel:", self.loglevel, flush=True)
         print("subsample:", self.subsample, flush=True)
         print("output_fmt:", self.output_fmt, flush=True)
+        if self.threadPlan != None:
+            print("threads:", self.threadPlan, flush=True)
         print("=======================================", flush=True)
 
-    
-        vmafProcess = self.ffmpegQos.getVmaf(model=self.model, subsample=self.subsample,
-                                             output_fmt=self.output_fmt, threads=self.threads, print_progress=self.print_progress, end_sync=self.end_sync, features=self.features, cambi_heatmap = self.cambi_heatmap)
+    def getThreadPlan(self, threads):
+        """threads of the stages of the VMAF run, for a budget of 'threads' (0: one per cpu). See Threads.getThreadPlan"""
+        return getThreadPlan(threads, self.decode_threads, self.filter_threads, self.vmaf_threads)
+
+    def _setVmafFilter(self, threads, outputID=None, logBase=None):
+        """
+        SSIM and MS-SSIM are computed by libvmaf in the same pass: per frame values are logged next to the VMAF scores
+        threads: budget of the run: libvmaf threads, unless vmaf_threads is set (see getThreadPlan)
+        """
+        if logBase == None:
+            logBase = os.path.splitext(self.mainSrc)[0]
+        self.threadPlan = self.getThreadPlan(threads)
+        self.ffmpegQos.main.decodeThreads = self.threadPlan.mainDecode
+        self.ffmpegQos.ref.decodeThreads = self.threadPlan.refDecode
+        self.ffmpegQos.filterThreads = self.threadPlan.filter
+        self.features = f'name=psnr|name={SSIM_FEATURE_NAME}|name={MS_SSIM_FEATURE_NAME}|name=cambi\\\\:full_ref=true\\\\:enc_width={self.main.streamInfo["width"]}\\\\:enc_height={self.main.streamInfo["height"]}\\\\:src_width={self.ref.streamInfo["width"]}\\\\:src_height={self.ref.streamInfo["height"]}'
+        self.ffmpegQos.setVmafFilter(model=self.model, subsample=self.subsample, output_fmt=self.output_fmt, threads=self.threadPlan.vmaf,
+                                     end_sync=self.end_sync, features=self.features, cambi_heatmap=self.cambi_heatmap, log_base=logBase, outputID=outputID)
+
+    def setVmafGraph(self, autoSync=False):
+        """
+        It sets the filter graph of the VMAF run without running it, i.e., to look up its result (FFmpegQos.getGraph())
+        """
+        self._setFilters(autoSync)
+        self._setVmafFilter(self.threads)
+
+    def isSegmented(self):
+        """True if VMAF is computed in segments. The cambi heatmap of a run can not be split, so it is not with cambi_heatmap"""
+        return self.segments > 1 and not self.cambi_heatmap
+
+    def _getSegments(self):
+        """
+        [start, frames] of the segments of the aligned timeline, in frames at the compared fps. It is split in 'segments'
+        parts of about the same length, whose boundaries are moved to the nearest keyframe of MAIN and then down to a
+        multiple of subsample, so that the frames scored are the ones of a single run. Segments may be merged on
+        videos with few keyframes.
+        """
+        fps = self._getComparedFps()
+        totalFrames = self.getComparedFrames()
+        mainStart = max(0, -self.offset)
+        keyframes = FFprobe(self.ffmpegQos.main.videoSrc, self.loglevel, cancel=self.cancel).getKeyframes()
+        keyframes = [frame for frame in (int(round((time - mainStart) * fps)) for time in keyframes)
+                     if 0 < frame < totalFrames]
+        bounds = [0]
+        for i in range(1, self.segments):
+            bound = int(i * totalFrames / self.segments)
+            if keyframes:
+                bound = min(keyframes, key=lambda frame: abs(frame - bound))
+            bound = bound - bound % self.subsample
+            if bound > bounds[-1]:
+                bounds.append(bound)
+        bounds.append(max(totalFrames, bounds[-1] + 1))
+        return [[bounds[i], bounds[i + 1] - bounds[i]] for i in range(len(bounds) - 1)]
+
+    def _getSegmentQos(self, segments, index, threads, cancel=None, logBase=None):
+        """
+        FFmpegQos of the VMAF run of segments[index] (see _getSegments), with its log at logBase.part{index}, and the
+        [partPath, start, end, shift] of its log for mergeVmafLogs().
+        Segments are extended by 'subsample' frames at their inner boundaries, so temporal features (motion) of their
+        first and last frames are computed from the same neighbours as in a single run. Those frames are not merged.
+        """
+        if logBase == None:
+            logBase = os.path.splitext(self.mainSrc)[0]
+        start, frames = segments[index]
+        preroll = self.subsample if index > 0 else 0
+        last = index == len(segments) - 1
+        ffmpegQos = self.ffmpegQos
+        try:
+            self.ffmpegQos = FFmpegQos(ffmpegQos.main.videoSrc, ffmpegQos.ref.videoSrc, self.loglevel, cancel,
+                                       ffmpegQos.main.sourceResolution, ffmpegQos.ref.sourceResolution,
+                                       ffmpegQos.main.sourceFps, ffmpegQos.ref.sourceFps)
+            self._setFilters(segment=[start - preroll, None if last else preroll + frames + self.subsample])
+            self._setVmafFilter(threads, logBase=f'{logBase}.part{index}')
+            segmentQos = self.ffmpegQos
+        finally:
+            self.ffmpegQos = ffmpegQos
+        return segmentQos, [segmentQos.vmafpath, preroll, None if last else preroll + frames, start - preroll]
+
+    def runSegment(self, segments, index, logBase=None):
+        """
+        It runs the VMAF graph of segments[index] only, i.e., in a worker (see Analysis.runJob), with all the threads.
+        It returns the [partPath, start, end, shift] of its log, to merge it with the others (see mergeVmafLogs).
+        """
+        segmentQos, part = self._getSegmentQos(segments, index, self.threads, self.cancel, logBase)
+        segmentQos._run()
+        return part
+
+    def _runSegments(self, segments, reporter=None):
+        """
+        VMAF of each segment ([start, frames], see _getSegments) in its own ffmpeg run, all of them at the same time,
+        each one with its share of the libvmaf threads. Each segment is decoded from the keyframe before it.
+        Logs of the segments are merged into the log of the VMAF graph (ffmpegQos.vmafpath). A log left at that path by
+        a previous run is removed first, and so is a partial merged log.
+        Temporal filters (denoise, deinterlacing) restart at each segment: near boundaries scores may differ slightly.
+        """
+        threads = self.threads if self.threads > 0 else os.cpu_count()
+        threads = max(1, threads // len(segments))
+        """
+        the segments are stopped together: if one of them fails, the others are killed. They have their own token,
+        child of the one of the analysis, so other analyses that share it (i.e., jobs of a batch) are not killed
+        """
+        cancel = CancelToken(self.cancel)
+        ffmpegQos = self.ffmpegQos
+        runs = []
+        parts = []
+        try:
+            for i in range(len(segments)):
+                segmentQos, part = self._getSegmentQos(segments, i, threads, cancel)
+                runs.append(segmentQos)
+                parts.append(part)
+
+            print("Segments:", ", ".join(f'{start}+{frames}' for start, frames in segments), "frames", flush=True)
+            partsReporter = PartsReporter(reporter, len(runs)) if reporter != None else None
+            ffmpegQos._removeLogs()
+            with ThreadPoolExecutor(max_workers=len(runs)) as pool:
+                futures = [pool.submit(run._run, False, partsReporter.getPart(i) if partsReporter else None)
+                           for i, run in enumerate(runs)]
+                try:
+                    processes = [future.result() for future in futures]
+                except BaseException:
+                    killAll(cancel)
+                    raise
+            try:
+                mergeVmafLogs(parts, ffmpegQos.vmafpath, self.output_fmt)
+            except BaseException:
+                ffmpegQos._removeLogs()
+                raise
+        finally:
+            for run in runs:
+                run._removeLogs()
+            if self.cancel != None:
+                self.cancel.removeChild(cancel)
+        if reporter != None:
+            reporter.finish()
+        return processes
+
+    def runVmaf(self):
+        """
+        It runs the VMAF graph set by setVmafGraph(). With segments > 1 the aligned timeline is split into segments
+        run at the same time (see _runSegments), and their logs are merged into the log of the graph.
+        """
+        self._printVmafInfo()
+        reporter = ProgressReporter(self.progress, 'vmaf', self.getComparedFrames()) if self.progress else None
+        if self.isSegmented():
+            segments = self._getSegments()
+            if len(segments) > 1:
+                return self._runSegments(segments, reporter)
+        vmafProcess = self.ffmpegQos._run(self.print_progress, reporter)
         return vmafProcess
 
+    def getVmaf(self, autoSync=False):
+        self.setVmafGraph(autoSync)
+        return self.runVmaf()
+
+
+class vmafLadder():
+    """
+    Class to manage VMAF computation of several MAIN videos (i.e., the rungs of an encoding ladder) against the same REF
+    in a single ffmpeg run: REF is decoded and scaled once and split into one branch per MAIN.
+    Each rung is a vmaf object (vmafLadder.rungs) that keeps its own deinterlacing, frame rate conversion, offset
+    and libvmaf log. Sync (rung.syncOffset) or standalone SSIM (rung.getSsim) of each rung must be run before getVmaf().
+    The ladder run is not split in segments: 'segments' is ignored.
+    """
+
+    def __init__(self, mainSrcs, refSrc, output_fmt, threads=0, **kwargs):
+        kwargs.pop('segments', None)
+        self.rungs = [vmaf(mainSrc, refSrc, output_fmt, threads=threads, **kwargs) for mainSrc in mainSrcs]
+        self.ref = self.rungs[0].ref
+        self.threads = threads
+        self.loglevel = self.rungs[0].loglevel
+        self.print_progress = self.rungs[0].print_progress
+        self.progress = self.rungs[0].progress
+        self.cancel = self.rungs[0].cancel
+        self.ffmpegQos = None
+
+    def getVmaf(self, rungs=None):
+        """
+        The libvmaf threads (default: one per cpu) are split between the rungs (see vmaf.getThreadPlan).
+        rungs: the rungs to compute, i.e., the ones not found in the results store. Default: all of them
+        """
+        if rungs == None:
+            rungs = self.rungs
+        refResolution = self.ref.getResolution()
+        target_resolution = rungs[0].target_resolution
+        self.ffmpegQos = FFmpegQosLadder(self.ref.videoSrc, [rung.main.videoSrc for rung in rungs], self.loglevel,
+                                         refResolution, self.cancel, [rung.main.getResolution() for rung in rungs],
+                                         getFrameRate(self.ref.streamInfo['r_frame_rate']),
+                                         [getFrameRate(rung.main.streamInfo['r_frame_rate']) for rung in rungs])
+        self.ffmpegQos.ref.setScaleFilter(target_resolution[0], target_resolution[1])
+        self.ffmpegQos.split()
+
+        threads = self.threads if self.threads > 0 else os.cpu_count()
+        threads = max(1, threads // len(rungs))
+        for i, rung in enumerate(rungs):
+            rung.ffmpegQos = self.ffmpegQos.rungs[i]
+            rung._setFilters()
+            rung._setVmafFilter(threads, outputID=f'vmaf{i}')
+            rung._printVmafInfo()
+        # REF is decoded and filtered once for every rung, by the graph of the ladder
+        self.ffmpegQos.ref.decodeThreads = rungs[0].threadPlan.refDecode
+        self.ffmpegQos.filterThreads = rungs[0].threadPlan.filter
+        reporter = None
+        if self.progress:
+            reporter = ProgressReporter(self.progress, 'vmaf', max(rung.getComparedFrames() for rung in rungs))
+        return self.ffmpegQos.getVmaf(self.print_progress, reporter)
+
 
 def getFrameRate(r_frame_rate):
     num, den = r_frame_rate.split('/')
@@ -0,0 +1,153 @@
+import json
+import xml.etree.ElementTree as ET
+import numpy as np
+from array import array
+from xml.sax.saxutils import quoteattr
+from JsonStream import JsonStreamReader
+
+
+POOLED_PERCENTILES = [1, 5, 50, 95]
+""" pooled stats written in the pooled_metrics of a libvmaf log """
+LOG_POOLED_STATS = ['min', 'max', 'mean', 'harmonic_mean']
+
+
+class VmafLogColumns:
+    '''
+    Compact columnar storage of the per frame values of a libvmaf log: one array of doubles per metric,
+    filled frame by frame while the log is read, so the frames are never kept as a list of dicts.
+
+    Inputs:
+        - metrics: names of the metrics to keep. Default: all the metrics of the first frame
+    Outputs:
+        - toArrays(): {metric: float64 array}. 'frameNum' has the frame numbers
+    '''
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.columns = None
+        self.frameNum = array('d')
+
+    def appendRow(self, values, frameNum):
+        """values: {metric: value} of one frame. Values may be strings (xml attributes)"""
+        if self.columns == None:
+            metrics = self.metrics
+            if metrics == None:
+                metrics = [name for name in values if name != 'frameNum']
+            self.columns = [(name, array('d')) for name in metrics]
+        self.frameNum.append(float(frameNum))
+        for name, column in self.columns:
+            column.append(float(values[name]))
+
+    def appendFrame(self, frame):
+        """frame: item of the 'frames' array of a json log"""
+        self.appendRow(frame['metrics'], frame['frameNum'])
+
+    def toArrays(self):
+        columns = self.columns
+        if columns == None:
+            columns = [(name, array('d')) for name in self.metrics or []]
+        arrays = {'frameNum': np.frombuffer(self.frameNum, dtype=np.float64)}
+        for name, column in columns:
+            arrays[name] = np.frombuffer(column, dtype=np.float64)
+        return arrays
+
+
+def readVmafLog(path, output_fmt='json', metrics=None):
+    """
+    Per frame values of a libvmaf log (json or xml) as {metric: float64 array}. 'frameNum' has the frame numbers.
+    metrics: names of the metrics to read. Default: all of them
+    Both formats are read incrementally: only the requested metrics of each frame are kept.
+    """
+    columns = VmafLogColumns(metrics)
+    if output_fmt == 'xml':
+        _readXmlFrames(path, columns)
+    else:
+        with open(path) as jsonFile:
+            JsonStreamReader(jsonFile, {'frames': columns.appendFrame}).read()
+    return columns.toArrays()
+
+
+def _readXmlFrames(path, columns):
+    """
+    It appends the <frame> elements of a libvmaf xml log to columns as they are parsed. Parsed frames are removed
+    from <frames>, so memory does not grow with the length of the log.
+    """
+    frames = None
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'frames':
+                frames = elem
+        elif elem.tag == 'frame':
+            columns.appendRow(elem.attrib, elem.attrib['frameNum'])
+            if frames != None:
+                frames.clear()
+
+
+def getPooled(values, percentiles=POOLED_PERCENTILES):
+    """
+    pooled stats of per frame values: mean, harmonic mean, min, max and percentiles ('p1', 'p5'...).
+    The harmonic mean is computed as libvmaf does, 1/mean(1/(x+1)) - 1, so zero values are allowed.
+    """
+    stats = {'mean': float('nan'), 'harmonic_mean': float('nan'), 'min': float('nan'), 'max': float('nan')}
+    stats.update({f'p{p:g}': float('nan') for p in percentiles})
+    if len(values) == 0:
+        return stats
+    stats['mean'] = float(values.mean())
+    stats['harmonic_mean'] = float(1.0 / np.mean(1.0 / (values + 1.0)) - 1.0)
+    stats['min'] = float(values.min())
+    stats['max'] = float(values.max())
+    for p, value in zip(percentiles, np.percentile(values, percentiles)):
+        stats[f'p{p:g}'] = float(value)
+    return stats
+
+
+def writeVmafLog(path, frames, output_fmt='json'):
+    """
+    It writes per frame values ({metric: array}, with 'frameNum') as a libvmaf log (json or xml) with the frames and
+    their pooled_metrics. Frames are written one by one.
+    """
+    metrics = [name for name in frames if name != 'frameNum']
+    frameNums = frames['frameNum'].astype(np.int64)
+    pooled = {name: getPooled(frames[name]) for name in metrics}
+    with open(path, 'w') as logFile:
+        if output_fmt == 'xml':
+            logFile.write('<?xml version="1.0" encoding="UTF-8"?>\n<VMAF>\n  <frames>\n')
+            for i, frameNum in enumerate(frameNums):
+                values = " ".join(f'{name}="{frames[name][i]:.6f}"' for name in metrics)
+                logFile.write(f'    <frame frameNum="{frameNum}" {values} />\n')
+            logFile.write('  </frames>\n  <pooled_metrics>\n')
+            for name in metrics:
+                stats = " ".join(f'{stat}="{pooled[name][stat]:.6f}"' for stat in LOG_POOLED_STATS)
+                logFile.write(f'    <metric name={quoteattr(name)} {stats} />\n')
+            logFile.write('  </pooled_metrics>\n  <aggregate_metrics />\n</VMAF>\n')
+        else:
+            logFile.write('{\n  "frames": [')
+            for i, frameNum in enumerate(frameNums):
+                frame = {'frameNum': int(frameNum), 'metrics': {name: float(frames[name][i]) for name in metrics}}
+                logFile.write(('\n    ' if i == 0 else ',\n    ') + json.dumps(frame))
+            pooledMetrics = {name: {stat: pooled[name][stat] for stat in LOG_POOLED_STATS} for name in metrics}
+            logFile.write('\n  ],\n  "pooled_metrics": ' + json.dumps(pooledMetrics) + ',\n  "aggregate_metrics": {}\n}\n')
+
+
+def mergeVmafLogs(parts, path, output_fmt='json'):
+    """
+    It merges the libvmaf logs of the segments of a run (see vmaf.runVmaf) into one log at path, in the same format,
+    with the frames in order and the pooled_metrics of all of them. It returns the merged per frame values.
+    parts: (partPath, start, end, shift) of each segment. Frames of the part with frameNum in [start, end) are kept,
+    numbered frameNum + shift in the merged log. end None: up to the end of the part.
+    A part without frames to keep leaves a gap in the timeline: ValueError is raised.
+    """
+    merged = {}
+    for partPath, start, end, shift in parts:
+        frames = readVmafLog(partPath, output_fmt)
+        keep = frames['frameNum'] >= start
+        if end != None:
+            keep &= frames['frameNum'] < end
+        if not keep.any():
+            raise ValueError(f'No frames in the segment log {partPath}')
+        frames['frameNum'] = frames['frameNum'] + shift
+        for name, values in frames.items():
+            merged.setdefault(name, []).append(values[keep])
+    frames = {name: np.concatenate(values) for name, values in merged.items()}
+    writeVmafLog(path, frames, output_fmt)
+    return frames
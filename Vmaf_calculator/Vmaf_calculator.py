@@ -3,20 +3,23 @@ import json
 import sys
 import os.path
 import glob
-import xml.etree.ElementTree as ET
-import subprocess  # For running FFmpeg commands for denoising and brightness adjustment
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from FFmpeg import HD_MODEL_NAME, HD_NEG_MODEL_NAME, HD_PHONE_MODEL_NAME, _4K_MODEL_NAME, HD_PHONE_MODEL_VERSION
-from statistics import mean
-from Vmaf import vmaf
+from FFmpeg import FFprobe, PROBE_DEPTHS, PREPROCESS_CODECS
+from Analysis import analyze, analyzeLadder, analyzeQueued, runJob, AnalysisResult
+from Cancel import CancelToken
+from JobQueue import JobQueue, runWorker, getWorkerId, HEARTBEAT_TIMEOUT
 from signal import signal, SIGINT
-import cv2  # for denoising and brightness adjustments
-from skimage.metrics import structural_similarity as ssim
+
+
+# Shared by all the jobs. ffmpeg children run in their own process groups, so CTRL-C does not reach them
+cancel = CancelToken()
 
 
 def handler(signal_received, frame):
-    print('SIGINT or CTRL-C detected. Exiting gracefully')
-    sys.exit(0)
+    print('SIGINT or CTRL-C detected. Stopping ffmpeg and exiting', flush=True)
+    cancel.cancel()
+    sys.exit(130)
 
 
 def get_args():
@@ -32,13 +35,19 @@ def get_args():
                       formatter_class=argparse.RawTextHelpFormatter)
     requiredgroup = parser.add_argument_group('required arguments')
     requiredgroup.add_argument(
-        '-d', dest='d', type=str, help='Distorted video', required=True)
+        '-d', dest='d', type=str, nargs='+', help='Distorted video(s). Each one can be a pattern, i.e., "myFolder/video-sample-*.mp4". Not used with -worker')
     requiredgroup.add_argument(
-        '-r', dest='r', type=str, help='Reference video ', required=True)
+        '-r', dest='r', type=str, help='Reference video. Not used with -worker')
     parser.add_argument('-sw', dest='sw', type=float, default=0,
                         help='Sync Window: window size in seconds of a subsample of the Reference video. The sync lookup will be done between the first frames of the Distorted input and this Subsample of the Reference. (default=0. No sync).')
     parser.add_argument('-ss', dest='ss', type=float, default=0,
                         help="Sync Start Time. Time in seconds from the beginning of the Reference video to which the Sync Window will be applied from. (default=0).")
+    parser.add_argument('-sync_search', dest='sync_search', type=str, default='auto',
+                        help="Sync search mode. Options: linear (every frame offset of the Sync Window), hierarchical (coarse to fine search on thumbnails, for long Sync Windows) or auto (hierarchical when the Sync Window is longer than 5 seconds). (Default: auto).")
+    parser.add_argument('-sync_margin', dest='sync_margin', type=float, default=3,
+                        help="Confidence margin in dB of the hierarchical sync search: peaks of the coarse search lower than the best one by this margin are not refined. (Default: 3).")
+    parser.add_argument('-sync_workers', dest='sync_workers', type=int, default=1,
+                        help="Number of workers used to score the sync offsets concurrently. 0: one per cpu. (Default: 1).")
     parser.add_argument('-fps', dest='fps', type=float, default=0,
                         help='Video Frame Rate: force frame rate conversion to <fps> value. Autodeinterlace is disabled when setting this')
     parser.add_argument('-subsample', dest='n', type=int, default=1,
@@ -47,7 +56,29 @@ def get_args():
     parser.add_argument('-model', dest='model', type=str, default="HD",
                         help="Vmaf Model. Options: HD, 4K. (Default: HD).")
     parser.add_argument('-threads', dest='threads', type=int,
-                        default=0, help='number of threads')
+                        default=0, help='number of threads. With -jobs, it is the cpu budget shared by all the jobs. (Default: 0, one per cpu)')
+    parser.add_argument('-decode_threads', dest='decode_threads', type=int, default=0,
+                        help='Decoder threads of each input (-threads of ffmpeg). (Default: 0, ffmpeg default).')
+    parser.add_argument('-filter_threads', dest='filter_threads', type=int, default=0,
+                        help='Threads of the scale, deinterlace and denoise filters (-filter_complex_threads of ffmpeg). (Default: 0, ffmpeg default).')
+    parser.add_argument('-vmaf_threads', dest='vmaf_threads', type=int, default=0,
+                        help='Threads of libvmaf (n_threads). (Default: 0, -threads).')
+    parser.add_argument('-jobs', dest='jobs', type=int, default=1,
+                        help='Number of Distorted files (see -d patterns) processed at the same time. The cpu budget (-threads) is split between them. (Default: 1).')
+    parser.add_argument(
+        '-ladder', action='store_true', default=False, help='Compute VMAF of all the Distorted files (see -d patterns) in a single ffmpeg run: the Reference is decoded and scaled once and shared by all of them. -jobs is ignored. (Default: false).')
+    parser.add_argument('-segments', dest='segments', type=int, default=1,
+                        help='Split the VMAF run of each Distorted file into N segments, on its keyframes, computed at the same time and merged into one log. It speeds up long videos, whose decode is otherwise serial. The threads of the job are split between them. Ignored with -ladder and -cambi_heatmap. (Default: 1).')
+    parser.add_argument('-queue', dest='queue', type=str, default=None,
+                        help='Path of a SQLite job queue shared with workers on any host (see -worker). The Distorted files, or their -segments, are submitted as jobs and computed by the workers; this process waits for the results. Videos must have the same paths on every host. (Default: None, computed here).')
+    parser.add_argument(
+        '-worker', action='store_true', default=False, help='Run the jobs of -queue until CTRL-C. -jobs N runs N jobs at a time, splitting -threads between them. Start as many workers as wanted, on any host. (Default: false).')
+    parser.add_argument('-job_timeout', dest='job_timeout', type=float, default=HEARTBEAT_TIMEOUT,
+                        help=f'Seconds without heartbeat of a worker before its job of -queue is queued again. (Default: {HEARTBEAT_TIMEOUT}).')
+    parser.add_argument(
+        '-idle_exit', action='store_true', default=False, help='With -worker, exit when no job is queued instead of waiting for new ones. (Default: false).')
+    parser.add_argument('-summary', dest='summary', type=str, default=None,
+                        help='Path of a json file with the scores of all the Distorted files. (Default: None).')
     parser.add_argument(
         '-verbose', help='Activate verbose loglevel. (Default: info).', action='store_true')
     parser.add_argument(
@@ -60,17 +91,35 @@ def get_args():
     
     parser.add_argument(
         '-cambi_heatmap', help='Activate cambi heatmap. (Default: false).', action='store_true')
+    parser.add_argument('-probe_depth', dest='probe_depth', type=str, default='head',
+                        help="How much of each video is read by ffprobe to detect interlacing and get frame statistics. Options: packets (first 5 seconds, no decode), head (first 5 seconds), sample (5 intervals of 1 second spread across the video) or full. (Default: head).")
+    parser.add_argument(
+        '-no_probe_cache', action='store_true', default=False, help='Do not use the on-disk cache of ffprobe results. It can also be disabled with VMAF_PROBE_CACHE=0')
+    parser.add_argument(
+        '-no_results_store', action='store_true', default=False, help='Always compute sync and VMAF, instead of reusing the results of previous runs with the same content and options. It can also be disabled with VMAF_RESULTS_STORE=0')
     parser.add_argument(
         '-sync_only', action='store_true', default=False, help='For sync measurement only. No Vmaf processing')
     
+    parser.add_argument(
+        '-ssim_standalone', action='store_true', default=False, help='Compute SSIM in a separate pass instead of reading it from the libvmaf features. (Default: false).')
+    parser.add_argument('-ssim_workers', dest='ssim_workers', type=int, default=0,
+                        help="Number of processes of the standalone SSIM pass. 0: one per cpu. They are limited, with the frames of their batches, to 1 GiB of buffers per pass. (Default: 0).")
+
     # New arguments for denoising and brightness
     parser.add_argument('-denoise', action='store_true', help='Apply denoising to the distorted video.')
     parser.add_argument('-brightness', type=float, default=1.0, help='Adjust brightness of the distorted video. (Default: 1.0)')
+    parser.add_argument('-preprocess_cache', dest='preprocess_cache', type=str, default='none',
+                        help="Keep a preprocessed (denoise/brightness) copy of the distorted video in the preprocessing cache instead of filtering it in the VMAF pass. Copies are lossless and reused by later runs. Options: none, ffv1, x264 (qp 0, ultrafast) or y4m (raw). (Default: none).")
 
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
         sys.exit(1)
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.worker and not args.queue:
+        parser.error('-worker requires -queue')
+    if not args.worker and (not args.d or not args.r):
+        parser.error('the following arguments are required: -d, -r')
+    return args
 
 
 class MyParser(argparse.ArgumentParser):
@@ -80,75 +129,101 @@ class MyParser(argparse.ArgumentParser):
         sys.exit(2)
 
 
-def get_unique_filename(base_path):
-    """Generates a unique filename by appending a number to the base name."""
-    counter = 1
-    file_name, file_extension = os.path.splitext(base_path)
-    new_file_path = base_path
-    while os.path.exists(new_file_path):
-        new_file_path = f"{file_name}_{counter}{file_extension}"
-        counter += 1
-    return new_file_path
+def run_job(main, reference, **analysis_args):
+    """Computes the scores of one Distorted file against the Reference (see Analysis.analyze) as a summary dict"""
+    return analyze(main, reference, **analysis_args).getSummary()
 
-def denoise_video(input_video_path, output_video_path):
-    """Applies denoising to a video using FFmpeg."""
-    
-    # Ensure output path is unique
-    output_video_path = get_unique_filename(output_video_path)
-
-    command = [
-        'ffmpeg',
-        '-i', input_video_path,
-        '-vf', 'hqdn3d',
-        '-c:a', 'copy',
-        output_video_path
-    ]
-    subprocess.run(command, check=True)
-
-def adjust_brightness(input_video_path, brightness_factor, output_video_path):
-    """
-    Adjusts the brightness of a video using FFmpeg.
-    :param input_video_path: Path to the input video file.
-    :param brightness_factor: A float indicating the brightness factor (1.0 = original brightness).
-    :param output_video_path: Path where the adjusted video will be saved.
-    """
-    # Ensure the output path is unique to avoid overwriting files
-    output_video_path = get_unique_filename(output_video_path)
-
-    # FFmpeg command to adjust brightness using 'eq' filter
-    command = [
-        'ffmpeg',
-        '-i', input_video_path,
-        '-vf', f'eq=brightness={brightness_factor - 1.0}',  # Adjust brightness
-        '-c:a', 'copy',  # Copy the audio without re-encoding
-        output_video_path
-    ]
-
-    # Run the command
-    subprocess.run(command, check=True)
-    
-def calculate_ssim(reference_path, distorted_path):
-    ref_video = cv2.VideoCapture(reference_path)
-    dist_video = cv2.VideoCapture(distorted_path)
-    ssim_scores = []
 
-    while ref_video.isOpened() and dist_video.isOpened():
-        ret_ref, frame_ref = ref_video.read()
-        ret_dist, frame_dist = dist_video.read()
+def run_ladder(mainFiles, reference, **analysis_args):
+    """As run_job(), for all the Distorted files in a single run that decodes the Reference once (see Analysis.analyzeLadder)"""
+    return [result.getSummary() for result in analyzeLadder(mainFiles, reference, **analysis_args)]
+
 
-        if not ret_ref or not ret_dist:
-            break
+def run_workers(queue, jobs, threads, idle_exit):
+    """Runs 'jobs' workers of the queue in this process (see JobQueue.runWorker), each one with its share of threads"""
+    def run(job, jobCancel):
+        return runJob(job, jobCancel, threads)
 
-        frame_ref_gray = cv2.cvtColor(frame_ref, cv2.COLOR_BGR2GRAY)
-        frame_dist_gray = cv2.cvtColor(frame_dist, cv2.COLOR_BGR2GRAY)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(runWorker, queue, run, getWorkerId(i), cancel, idle_exit) for i in range(jobs)]
+        for future in futures:
+            future.result()
 
-        score, _ = ssim(frame_ref_gray, frame_dist_gray, full=True)
-        ssim_scores.append(score)
 
-    ref_video.release()
-    dist_video.release()
+def print_result(result):
+    """prints the scores of one job, as they are parsed by the GUI"""
+    if 'error' in result:
+        print("[Vmaf-Calculator] ERROR:", result['distorted'], "|", result['error'], flush=True)
+        return
+    if 'vmaf_path' not in result:
+        print("offset: ", result['offset'], flush=True)
+        return
+    print("\n \n \n ")
+    print("=======================================", flush=True)
+    if result.get('cached'):
+        print("VMAF computed (from the results store)", flush=True)
+    else:
+        print("VMAF computed", flush=True)
+    print("=======================================", flush=True)
+    print("Distorted: ", result['distorted'], flush=True)
+    print("offset: ", result['offset'], " | psnr: ", result['psnr'])
+    print(f"SSIM Score: {result['ssim']}")
+    print(f"MS-SSIM Score: {result['ms_ssim']}")
+    if 'vmaf_hd' in result:
+        print("VMAF HD: ", result['vmaf_hd'])
+        print("VMAF Neg: ", result['vmaf_neg'])
+        print("VMAF Phone: ", result['vmaf_phone'])
+    if 'vmaf_4k' in result:
+        print("VMAF 4K: ", result['vmaf_4k'])
+    print("VMAF output file path: ", result['vmaf_path'])
+    if 'cambi_heatmap_path' in result:
+        print("CAMBI Heatmap output path: ", result['cambi_heatmap_path'])
+
+    print("\n \n \n ", flush=True)
+
+
+def print_summary(results):
+    """one line per Distorted file, in the order of the pattern expansion"""
+    print("=======================================", flush=True)
+    print("Summary:", len(results), "files", flush=True)
+    print("=======================================", flush=True)
+    for result in results:
+        if 'error' in result:
+            scores = f"ERROR: {result['error']}"
+        elif 'vmaf_path' not in result:
+            scores = f"offset: {result['offset']}"
+        else:
+            vmafKey = 'vmaf_hd' if 'vmaf_hd' in result else 'vmaf_4k'
+            scores = f"offset: {result['offset']} | SSIM: {result['ssim']:.6f} | MS-SSIM: {result['ms_ssim']:.6f} | VMAF: {result[vmafKey]:.4f}"
+        print(result['distorted'], "|", scores, flush=True)
+    print("=======================================", flush=True)
+
 
-    return mean(ssim_scores) if ssim_scores else 0
+def run_batch(mainFiles, reference, jobs, job_kwargs):
+    """
+    Runs run_job() for every Distorted file, 'jobs' files at a time. Results are printed as jobs finish
+    and returned in the order of mainFiles. A failed job does not stop the others.
+    """
+    results = {}
+
+    def run(main):
+        try:
+            return run_job(main, reference, **job_kwargs)
+        except Exception as e:
+            return {'distorted': main, 'error': str(e)}
+
+    if jobs == 1:
+        for main in mainFiles:
+            results[main] = run(main)
+            print_result(results[main])
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(run, main) for main in mainFiles]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result['distorted']] = result
+                print_result(result)
+    return [results[main] for main in mainFiles]
 
 
 if __name__ == '__main__':
@@ -165,6 +240,9 @@ if __name__ == '__main__':
     fps = abs(cmdParser.fps)
     n_subsample = abs(cmdParser.n)
     reverse = cmdParser.reverse
+    sync_search = cmdParser.sync_search
+    sync_margin = abs(cmdParser.sync_margin)
+    sync_workers = abs(cmdParser.sync_workers)
     model = cmdParser.model
     verbose = cmdParser.verbose
     output_fmt = cmdParser.output_fmt
@@ -175,6 +253,26 @@ if __name__ == '__main__':
     sync_only = cmdParser.sync_only
     denoise = cmdParser.denoise
     brightness_factor = cmdParser.brightness
+    probe_depth = cmdParser.probe_depth
+    ssim_workers = abs(cmdParser.ssim_workers)
+    preprocess_cache = cmdParser.preprocess_cache
+    jobs = abs(cmdParser.jobs)
+    segments = max(1, abs(cmdParser.segments))
+    decode_threads = abs(cmdParser.decode_threads)
+    filter_threads = abs(cmdParser.filter_threads)
+    vmaf_threads = abs(cmdParser.vmaf_threads)
+
+    if cmdParser.no_probe_cache:
+        FFprobe.cache = None
+    if cmdParser.no_results_store:
+        AnalysisResult.store = None
+
+    # Worker of a job queue: the options of each job are the ones of the coordinator that submitted it
+    if cmdParser.worker:
+        jobs = max(1, jobs)
+        cpu_budget = threads if threads > 0 else os.cpu_count()
+        run_workers(JobQueue(cmdParser.queue, cmdParser.job_timeout), jobs, max(1, cpu_budget // jobs), cmdParser.idle_exit)
+        sys.exit(0)
 
     # Setting verbosity
     if verbose:
@@ -182,6 +280,26 @@ if __name__ == '__main__':
     else:
         loglevel = "info"
 
+    # Check sync search mode
+    if sync_search not in ["auto", "linear", "hierarchical"]:
+        print("sync_search: ", sync_search,
+              " Not supported. auto used instead", flush=True)
+        sync_search = "auto"
+
+    # Check probe depth
+    if probe_depth not in PROBE_DEPTHS:
+        print("probe_depth: ", probe_depth,
+              " Not supported. head used instead", flush=True)
+        probe_depth = "head"
+
+    # Check preprocessing cache codec
+    if preprocess_cache == "none":
+        preprocess_cache = None
+    elif preprocess_cache not in PREPROCESS_CODECS:
+        print("preprocess_cache: ", preprocess_cache,
+              " Not supported. ffv1 used instead", flush=True)
+        preprocess_cache = "ffv1"
+
     # Check output format
     if output_fmt not in ["json", "xml"]:
         print("output_fmt: ", output_fmt,
@@ -189,103 +307,65 @@ if __name__ == '__main__':
         output_fmt = "json"
 
     ''' Distorted video path could be loaded as patterns i.e., "myFolder/video-sample-*.mp4" '''
-    main_pattern = os.path.expanduser(main_pattern)
-    mainFiles = glob.glob(main_pattern)
+    # A file matched by several patterns is processed once: its jobs would write the same libvmaf log
+    mainFiles = []
+    seen = set()
+    for pattern in main_pattern:
+        for path in glob.glob(os.path.expanduser(pattern)):
+            if os.path.realpath(path) not in seen:
+                seen.add(os.path.realpath(path))
+                mainFiles.append(path)
     
-    #Calculate SSIM and PSNR
-    ssim_score = calculate_ssim(reference, main_pattern)
-
     if not(os.path.isfile(reference)):
         print("Reference Video file not found: ", reference, flush=True)
         sys.exit(1)
 
     if len(mainFiles) == 0:
         print("Distorted Video files not found with the given pattern/name: ",
-              main_pattern, flush=True)
+              " ".join(main_pattern), flush=True)
         sys.exit(1)
 
-    for main in mainFiles:
-        # Apply brightness adjustment if specified
-        if brightness_factor != 1.0:
-            adjusted_brightness_path = f"adjusted_{os.path.basename(main)}"
-            adjust_brightness(main, brightness_factor, adjusted_brightness_path)
-            main = adjusted_brightness_path
-
-        # Apply denoising if specified
-        if denoise:
-            denoised_video_path = f"denoised_{os.path.basename(main)}"
-            denoise_video(main, denoised_video_path)
-            main = denoised_video_path
-
-        myVmaf = vmaf(main, reference, loglevel=loglevel, subsample=n_subsample, model=model,
-                      output_fmt=output_fmt, threads=threads, print_progress=print_progress, end_sync=end_sync, manual_fps=fps, cambi_heatmap=cambi_heatmap)
-
-        '''check if syncWin was set. If true offset is computed automatically, otherwise manual values are used  '''
-        if syncWin > 0:
-            offset, psnr = myVmaf.syncOffset(syncWin, ss, reverse)
-            if cmdParser.sync_only:
-                print("offset: ", offset, flush=True)
-                sys.exit(1)
-        else:
-            offset = ss
-            psnr = None
-            if reverse:
-                myVmaf.offset = -offset
-            else:
-                myVmaf.offset = offset
-
-        vmafProcess = myVmaf.getVmaf()
-        vmafpath = myVmaf.ffmpegQos.vmafpath
-        vmafScore = []
-        vmafNegScore = []
-        vmafPhoneScore = []
-
-        if output_fmt == 'json':
-            with open(vmafpath) as jsonFile:
-                jsonData = json.load(jsonFile)
-                for frame in jsonData['frames']:
-                    if model == 'HD':
-                        vmafScore.append(frame["metrics"][HD_MODEL_NAME])
-                        vmafNegScore.append(frame["metrics"][HD_NEG_MODEL_NAME])
-                        vmafPhoneScore.append(frame["metrics"][HD_PHONE_MODEL_NAME])
-                    if model == '4K':
-                        vmafScore.append(frame["metrics"][_4K_MODEL_NAME])
-
-        elif output_fmt == 'xml':
-            tree = ET.parse(vmafpath)
-            root = tree.getroot()
-            for frame in root.findall('frames/frame'):
-                if model == 'HD':
-                    vmafScore.append(frame["metrics"][HD_MODEL_NAME])
-                    vmafNegScore.append(frame["metrics"][HD_NEG_MODEL_NAME])
-                    vmafPhoneScore.append(frame["metrics"][HD_PHONE_MODEL_NAME])
-                if model == '4K':
-                    vmafScore.append(frame["metrics"][_4K_MODEL_NAME])
-
-        print("\n \n \n ")
+    ''' CPU budget: split between the concurrent jobs. Each job gets its share for libvmaf threads and workers '''
+    if cmdParser.ladder:
+        jobs = 1
+    jobs = max(1, min(jobs, len(mainFiles)))
+    cpu_budget = threads if threads > 0 else os.cpu_count()
+    job_threads = max(1, cpu_budget // jobs)
+    if jobs > 1:
+        if sync_workers == 0:
+            sync_workers = job_threads
+        if ssim_workers == 0:
+            ssim_workers = job_threads
         print("=======================================", flush=True)
-        print("VMAF computed", flush=True)
+        print("Batch:", len(mainFiles), "files |", jobs, "jobs |", job_threads, "threads per job", flush=True)
         print("=======================================", flush=True)
-        print("offset: ", offset, " | psnr: ", psnr)
-        print(f"SSIM Score: {ssim_score}")
-        if model == 'HD':
-            print("VMAF HD: ", mean(vmafScore))
-            print("VMAF Neg: ", mean(vmafNegScore))
-            print("VMAF Phone: ", mean(vmafPhoneScore))
-        if model == '4K':
-            print("VMAF 4K: ", mean(vmafScore))
-        print("VMAF output file path: ", myVmaf.ffmpegQos.vmafpath)
-        if cambi_heatmap:
-            print("CAMBI Heatmap output path: ", myVmaf.ffmpegQos.vmaf_cambi_heatmap_path)
-
-        print("\n \n \n ")
-
-
-
-
-
-
-
 
+    # Brightness adjustment and denoising are filters of the distorted branch, unless a lossless copy is kept in the preprocessing cache
+    vmaf_args = dict(loglevel=loglevel, subsample=n_subsample, model=model,
+                     output_fmt=output_fmt, threads=job_threads, print_progress=print_progress, end_sync=end_sync, manual_fps=fps, cambi_heatmap=cambi_heatmap, sync_workers=sync_workers, probe_depth=probe_depth, denoise=denoise, brightness=brightness_factor, preprocess_cache=preprocess_cache, cancel=cancel, segments=segments, decode_threads=decode_threads, filter_threads=filter_threads, vmaf_threads=vmaf_threads)
+    job_kwargs = dict(syncWindow=syncWin, syncStart=ss, reverse=reverse, syncSearch=sync_search, syncMargin=sync_margin,
+                      ssimStandalone=cmdParser.ssim_standalone, ssimWorkers=ssim_workers, syncOnly=sync_only, **vmaf_args)
+    if cmdParser.queue:
+        queue_kwargs = {key: value for key, value in job_kwargs.items() if key not in ['cancel', 'segments']}
+        results = analyzeQueued(JobQueue(cmdParser.queue, cmdParser.job_timeout), mainFiles, reference,
+                                segments=segments, cancel=cancel, **queue_kwargs)
+        for result in results:
+            print_result(result)
+    elif cmdParser.ladder:
+        results = run_ladder(mainFiles, reference, **job_kwargs)
+        for result in results:
+            print_result(result)
+    else:
+        results = run_batch(mainFiles, reference, jobs, job_kwargs)
 
+    if len(results) > 1:
+        print_summary(results)
+    if cmdParser.summary:
+        with open(cmdParser.summary, 'w') as summaryFile:
+            json.dump(results, summaryFile, indent=4)
+        print("Summary file path: ", cmdParser.summary, flush=True)
 
+    if sync_only and syncWin > 0:
+        sys.exit(1)
+    if any('error' in result for result in results):
+        sys.exit(1)
@@ -1,5 +1,12 @@
-
+import os
 import shutil
 
 ffmpeg = shutil.which("ffmpeg")
-ffprobe = shutil.which("ffprobe")
\ No newline at end of file
+ffprobe = shutil.which("ffprobe")
+
+cache_dir = os.environ.get('VMAF_CACHE_DIR', os.path.join(
+    os.path.expanduser('~'), '.cache', 'vmaf-calculator'))
+probe_cache = os.environ.get('VMAF_PROBE_CACHE', '1') != '0'
+probe_cache_size = 64 * 1024 * 1024
+results_store = os.environ.get('VMAF_RESULTS_STORE', '1') != '0'
+preprocess_cache_size = 20 * 1024 * 1024 * 1024
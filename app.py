@@ -1,9 +1,9 @@
 
 import sys
-import subprocess
+import os
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout,
-    QPushButton, QSizePolicy, QFileDialog, QMessageBox, QHeaderView, QSlider, QLabel, QTextEdit, QSpinBox, QDialog, QScrollArea, QGroupBox
+    QPushButton, QSizePolicy, QFileDialog, QMessageBox, QHeaderView, QSlider, QLabel, QTextEdit, QSpinBox, QDialog, QScrollArea, QGroupBox, QCheckBox, QProgressBar
 
 )
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
@@ -17,11 +17,23 @@ import matplotlib
 matplotlib.use('Qt5Agg') 
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas  
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Vmaf_calculator'))
+from Analysis import analyze, analyzeLadder
+from FFmpeg import HD_MODEL_NAME, PSNR_FEATURE_NAME
+from Cancel import CancelToken, Cancelled
 
 
 
 class AnalysisThread(QThread):
+    """
+    Analysis of an encoded video against the reference, in this process (see Vmaf_calculator/Analysis.py).
+    The AnalysisResult (per frame arrays and pooled scores) is emitted with its codec type; errors are emitted as progress text.
+    Live progress of each stage (sync, ssim, vmaf) is emitted as stats: codec type, stage, percent, frame, fps and eta (or None).
+    stop() cancels the analysis from the GUI thread: its ffmpeg processes are killed and partial logs removed.
+    """
     progress = pyqtSignal(str, str)  
+    result = pyqtSignal(str, object)
+    stats = pyqtSignal(str, str, float, int, float, object)
 
     def __init__(self, ref_video_path, enc_video_path, codec_type, params, parent=None):
         super().__init__(parent)
@@ -29,39 +41,74 @@ class AnalysisThread(QThread):
         self.enc_video_path = enc_video_path
         self.codec_type = codec_type
         self.params = params
+        self.cancel = CancelToken()
 
     def run(self):
         self.calculate_metrics(self.ref_video_path, self.enc_video_path)
 
+    def stop(self):
+        self.cancel.cancel()
+
+    def analysis_args(self, codec_types=None):
+        codec_types = codec_types or [self.codec_type]
+
+        def emit_stats(stage, percent, frame, fps, eta):
+            for codec_type in codec_types:
+                self.stats.emit(codec_type, stage, percent, frame, fps, eta)
+
+        return dict(
+            syncWindow=self.params['sync_window'],
+            syncStart=self.params['sync_start_time'],
+            manual_fps=self.params['frame_rate'],
+            subsample=self.params['subsample'],
+            threads=self.params['threads'],
+            progress=emit_stats,
+            cancel=self.cancel
+        )
+
     def calculate_metrics(self, ref_video_path, enc_video_path):
         try:
-            cmd = [
-                'python3', 'Vmaf_calculator/Vmaf_calculator.py',  # Update this path accordingly
-                '-d', enc_video_path,
-                '-r', ref_video_path,                                                                           
-                '-sw', str(self.params['sync_window']),
-                '-ss', str(self.params['sync_start_time']),
-                '-fps', str(self.params['frame_rate']),
-                '-subsample', str(self.params['subsample']),
-                '-threads', str(self.params['threads'])
-            ]
-
-            print("Executing Command:", ' '.join(cmd))  # Debugging line
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-            # Handle output
-            stdout, stderr = process.communicate()  # Wait for the process to finish
-            self.progress.emit(self.codec_type, stdout.strip())
-            if stderr:
-                self.progress.emit(self.codec_type, stderr.strip())
-        
-            if process.returncode != 0:
-                self.progress.emit(self.codec_type, f"Error: Process exited with code {process.returncode}")
+            result = analyze(enc_video_path, ref_video_path, **self.analysis_args())
+            if result.cached:
+                self.progress.emit(self.codec_type, "Scores read from the results store.")
+            self.result.emit(self.codec_type, result)
+
+        except Cancelled:
+            self.progress.emit(self.codec_type, "Analysis stopped.")
 
         except Exception as e:
             self.progress.emit(self.codec_type, f"Error: {str(e)}")
 
 
+class LadderAnalysisThread(AnalysisThread):
+    """
+    Analysis of several encoded videos against the same reference in a single ffmpeg run,
+    so the reference is decoded only once. Each AnalysisResult is emitted with its codec type.
+    enc_videos: {codec_type: video path}
+    """
+
+    def __init__(self, ref_video_path, enc_videos, params, parent=None):
+        super().__init__(ref_video_path, None, None, params, parent)
+        self.enc_videos = enc_videos
+
+    def calculate_metrics(self, ref_video_path, enc_video_path):
+        try:
+            results = analyzeLadder(list(self.enc_videos.values()), ref_video_path,
+                                    **self.analysis_args(list(self.enc_videos)))
+            for codec_type, result in zip(self.enc_videos, results):
+                if result.cached:
+                    self.progress.emit(codec_type, "Scores read from the results store.")
+                self.result.emit(codec_type, result)
+
+        except Cancelled:
+            for codec_type in self.enc_videos:
+                self.progress.emit(codec_type, "Analysis stopped.")
+
+        except Exception as e:
+            for codec_type in self.enc_videos:
+                self.progress.emit(codec_type, f"Error: {str(e)}")
+
+
 class HelpDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -186,6 +233,7 @@ class VideoPlayer(QWidget):
         # Track analysis completion
         self.h264_done = False
         self.h265_done = False
+        self.analysis_threads = []
 
         # Create video widgets
         self.reference_video_widget = QVideoWidget()
@@ -214,6 +262,10 @@ class VideoPlayer(QWidget):
         self.h265_results_box = QTextEdit()
         self.h265_results_box.setReadOnly(True)
         self.h265_results_box.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
+
+        # Live progress of the running stage of each analysis
+        self.h264_progress_bar = QProgressBar()
+        self.h265_progress_bar = QProgressBar()
         
         # Initialize the table
         self.comparison_results_table = QTableWidget()
@@ -238,6 +290,7 @@ class VideoPlayer(QWidget):
         self.pause_button = QPushButton("Pause Videos")
         self.stop_button = QPushButton("Stop Videos")
         self.analyze_button = QPushButton("Analyze Videos")
+        self.stop_analysis_button = QPushButton("Stop Analysis")
         self.plot_button = QPushButton("Show Graphical Comparison")
 
         # Set initial button states
@@ -245,6 +298,7 @@ class VideoPlayer(QWidget):
         self.pause_button.setEnabled(False)
         self.stop_button.setEnabled(False)
         self.analyze_button.setEnabled(False)
+        self.stop_analysis_button.setEnabled(False)
         self.plot_button.setEnabled(False)
 
         # Connect buttons to functions
@@ -252,6 +306,7 @@ class VideoPlayer(QWidget):
         self.pause_button.clicked.connect(self.pause_videos)
         self.stop_button.clicked.connect(self.stop_videos)
         self.analyze_button.clicked.connect(self.analyze_videos)
+        self.stop_analysis_button.clicked.connect(self.stop_analysis)
         self.plot_button.clicked.connect(self.plot_comparison)
 
         # Slider for seeking
@@ -265,6 +320,7 @@ class VideoPlayer(QWidget):
         self.frame_rate_input = QSpinBox()
         self.subsample_input = QSpinBox()
         self.threads_input = QSpinBox()
+        self.share_reference_checkbox = QCheckBox()
 
         # Set input ranges and initial values for sliders and spinboxes
         self.sync_window_input.setRange(1, 100)
@@ -382,6 +438,9 @@ class VideoPlayer(QWidget):
         param_layout.addWidget(self.threads_input)
         param_layout.addWidget(self.threads_slider)
 
+        self.add_info_icon("Share Reference:", "Analyzes both encoded videos in a single run that decodes the reference video only once. Otherwise both analyses run at the same time, each one with half of the threads.", param_layout)
+        param_layout.addWidget(self.share_reference_checkbox)
+
         # Buttons for Play, Pause, Stop, Analyze, Graph (spacing between buttons)
         button_layout = QHBoxLayout()
         button_layout.setSpacing(10)  # Add gap between buttons
@@ -389,6 +448,7 @@ class VideoPlayer(QWidget):
         button_layout.addWidget(self.pause_button)
         button_layout.addWidget(self.stop_button)
         button_layout.addWidget(self.analyze_button)
+        button_layout.addWidget(self.stop_analysis_button)
         button_layout.addWidget(self.plot_button)
 
         # Add Parameter layout and Button layout to main layout
@@ -400,11 +460,13 @@ class VideoPlayer(QWidget):
         result_layout.setSpacing(15)  # Add gap between result cards
         
          # H.264 Result Card
-        h264_card_result = self.create_result_card("H.264 Analysis Result", self.h264_results_box)
+        h264_card_result = self.create_result_card("H.264 Analysis Result", self.h264_results_box,
+                                                   progress_bar=self.h264_progress_bar)
         result_layout.addWidget(h264_card_result,1)
 
         # H.265 Result Card
-        h265_card_result = self.create_result_card("H.265 Analysis Result", self.h265_results_box)
+        h265_card_result = self.create_result_card("H.265 Analysis Result", self.h265_results_box,
+                                                   progress_bar=self.h265_progress_bar)
         result_layout.addWidget(h265_card_result,1)
 
         # Comparison Result Card
@@ -589,8 +651,18 @@ class VideoPlayer(QWidget):
 
     def analyze_videos(self):
         if self.ref_video_path and self.video_path_1 and self.video_path_2:
+            self.h264_done = False
+            self.h265_done = False
+            self.clear_comparison()
+            self.analyze_button.setEnabled(False)
+            self.stop_analysis_button.setEnabled(True)
             self.h264_results_box.clear()
             self.h264_results_box.append("Starting H.264 analysis...\n")
+            self.h265_results_box.clear()
+            self.h265_results_box.append("Starting H.265 analysis...\n")
+            for progress_bar in (self.h264_progress_bar, self.h265_progress_bar):
+                progress_bar.setValue(0)
+                progress_bar.setFormat("Waiting...")
 
             params = {
                 'sync_window': self.sync_window_input.value(),
@@ -600,84 +672,115 @@ class VideoPlayer(QWidget):
                 'threads': self.threads_input.value()
             }
 
+            if self.share_reference_checkbox.isChecked() and self.video_path_1 != self.video_path_2:
+                # Both analyses in a single run: the reference is decoded once and the threads are shared
+                self.thread_ladder = LadderAnalysisThread(
+                    self.ref_video_path, {"H.264": self.video_path_1, "H.265": self.video_path_2}, params)
+                self.thread_ladder.progress.connect(self.on_analysis_progress)
+                self.thread_ladder.stats.connect(self.on_analysis_stats)
+                self.thread_ladder.result.connect(self.on_analysis_result)
+                self.thread_ladder.result.connect(self.update_h264_result_box)
+                self.thread_ladder.result.connect(self.update_h265_result_box)
+                self.thread_ladder.finished.connect(self.on_h264_finished)
+                self.thread_ladder.finished.connect(self.on_h265_finished)
+                self.analysis_threads = [self.thread_ladder]
+                self.thread_ladder.start()
+                return
+
+            # H.264 and H.265 analyses run at the same time, each one with half of the threads
+            params['threads'] = max(1, params['threads'] // 2)
+
             # Start analysis for H.264
             self.thread_h264 = AnalysisThread(self.ref_video_path, self.video_path_1, "H.264", params)
             self.thread_h264.progress.connect(self.on_analysis_progress)
-            self.thread_h264.progress.connect(self.update_h264_result_box)
-            self.thread_h264.finished.connect(self.start_h265_analysis)  # Start H.265 when H.264 finishes
+            self.thread_h264.stats.connect(self.on_analysis_stats)
+            self.thread_h264.result.connect(self.on_analysis_result)
+            self.thread_h264.result.connect(self.update_h264_result_box)
+            self.thread_h264.finished.connect(self.on_h264_finished)
             self.thread_h264.start()
 
-    def start_h265_analysis(self):
-        self.h264_results_box.append("\nH.264 analysis completed.\n")
-        self.h264_done = True  # Mark H.264 as completed
-        self.h265_results_box.append("Starting H.265 analysis...\n")
-
-        params = {
-            'sync_window': self.sync_window_input.value(),
-            'sync_start_time': self.sync_start_time_input.value(),
-            'frame_rate': self.frame_rate_input.value(),
-            'subsample': self.subsample_input.value(),
-            'threads': self.threads_input.value()
-        }
-
-        # Start analysis for H.265
-        self.thread_h265 = AnalysisThread(self.ref_video_path, self.video_path_2, "H.265", params)
-        self.thread_h265.progress.connect(self.on_analysis_progress)
-        self.thread_h265.progress.connect(self.update_h265_result_box)
-        self.thread_h265.finished.connect(self.on_h265_finished)  # Update when H.265 finishes
-        self.thread_h265.finished.connect(self.display_comparison)
-        self.thread_h265.start()
+            # Start analysis for H.265
+            self.thread_h265 = AnalysisThread(self.ref_video_path, self.video_path_2, "H.265", params)
+            self.thread_h265.progress.connect(self.on_analysis_progress)
+            self.thread_h265.stats.connect(self.on_analysis_stats)
+            self.thread_h265.result.connect(self.on_analysis_result)
+            self.thread_h265.result.connect(self.update_h265_result_box)
+            self.thread_h265.finished.connect(self.on_h265_finished)
+            self.thread_h265.start()
+            self.analysis_threads = [self.thread_h264, self.thread_h265]
+
+    def stop_analysis(self):
+        # Cancel the running analyses: their ffmpeg processes are killed at once
+        self.stop_analysis_button.setEnabled(False)
+        for thread in self.analysis_threads:
+            if thread.isRunning():
+                thread.stop()
+
+    def closeEvent(self, event):
+        # Do not leave analyses (and their ffmpeg processes) running after the window is closed
+        for thread in self.analysis_threads:
+            thread.stop()
+            thread.wait()
+        super().closeEvent(event)
+
+    def clear_comparison(self):
+        # Results of a previous run are not shown or plotted as the ones of a new run
+        self.results = {}
+        self.comparison_results_table.clearContents()
+        self.plot_button.setEnabled(False)
+        while self.comparison_graph_layout.count():
+            widget = self.comparison_graph_layout.takeAt(0).widget()
+            if widget is not None:
+                widget.deleteLater()
 
+    def on_h264_finished(self):
+        # A stopped or failed analysis already reported why it ended
+        if "H.264" in self.results:
+            self.h264_results_box.append("\nH.264 analysis completed.\n")
+        self.h264_done = True  # Mark H.264 as completed
+        self.display_comparison()
 
     def on_h265_finished(self):
-        self.h265_results_box.append("\nH.265 analysis completed.\n")
+        if "H.265" in self.results:
+            self.h265_results_box.append("\nH.265 analysis completed.\n")
         self.h265_done = True  # Mark H.265 as completed
-        # Enable plot button if both analyses are done
-        if self.h264_done and self.h265_done:
-            self.plot_button.setEnabled(True)
+        self.display_comparison()
     
     def on_analysis_progress(self, codec_type, output):
-        try:
-            # Initialize the extracted metrics
-            psnr = None
-            ssim = None
-            vmaf = None
-
-            # Split the output by lines to process each line separately
-            lines = output.splitlines()
-
-            # Loop through each line to extract the relevant metrics
-            for line in lines:
-                if "psnr:" in line:
-                    psnr = float(line.split("psnr:")[-1].strip())
-                elif "SSIM Score:" in line:
-                    ssim = float(line.split("SSIM Score:")[-1].strip())
-                elif "VMAF HD:" in line:
-                    vmaf = line.split("VMAF HD:")[-1].strip()
-
-            # Update the results box with the extracted metrics
-            if psnr is not None and ssim is not None and vmaf is not None:
-                # Store the extracted values for comparison later
-                self.results[codec_type] = {"psnr": psnr, "ssim": ssim, "vmaf": vmaf}
-
-        except Exception as e:
-            self.comparison_results_box.append(f"Error parsing {codec_type} output: {str(e)}")
+        if codec_type == "H.264":
+            self.h264_results_box.append(output)
+        else:
+            self.h265_results_box.append(output)
+
+    def on_analysis_stats(self, codec_type, stage, percent, frame, fps, eta):
+        progress_bar = self.h264_progress_bar if codec_type == "H.264" else self.h265_progress_bar
+        eta_text = f"{eta:.0f} s" if eta is not None else "--"
+        progress_bar.setValue(int(percent))
+        progress_bar.setFormat(f"{stage.upper()} %p% | frame {frame} | {fps:.1f} fps | ETA {eta_text}")
+
+    def on_analysis_result(self, codec_type, result):
+        # Store the pooled scores for comparison later, at full precision
+        self.results[codec_type] = {
+            "psnr": result.pooled[PSNR_FEATURE_NAME]['mean'],
+            "ssim": result.getSsim(),
+            "vmaf": result.pooled[HD_MODEL_NAME]['mean'],
+            "analysis": result
+        }
             
     def display_comparison(self):
-        if "H.264" in self.results and "H.265" in self.results:
-            h264 = self.results["H.264"]
-            h265 = self.results["H.265"]
-
-            # Fill the table with formatted results (up to 10 decimal places)
-            self.comparison_results_table.setItem(0, 0, QTableWidgetItem(f"{h264['psnr']:.10f}"))
-            self.comparison_results_table.setItem(0, 1, QTableWidgetItem(f"{h265['psnr']:.10f}"))
-
-            self.comparison_results_table.setItem(1, 0, QTableWidgetItem(f"{h264['ssim']:.10f}"))
-            self.comparison_results_table.setItem(1, 1, QTableWidgetItem(f"{h265['ssim']:.10f}"))
+        # Fill the column of each codec as soon as its results are available (up to 10 decimal places)
+        for column, codec_type in enumerate(["H.264", "H.265"]):
+            if codec_type in self.results:
+                result = self.results[codec_type]
+                self.comparison_results_table.setItem(0, column, QTableWidgetItem(f"{result['psnr']:.10f}"))
+                self.comparison_results_table.setItem(1, column, QTableWidgetItem(f"{result['ssim']:.10f}"))
+                self.comparison_results_table.setItem(2, column, QTableWidgetItem(f"{result['vmaf']}"))
 
-            self.comparison_results_table.setItem(2, 0, QTableWidgetItem(f"{h264['vmaf']}"))
-            self.comparison_results_table.setItem(2, 1, QTableWidgetItem(f"{h265['vmaf']}"))
+        if self.h264_done and self.h265_done:
+            self.analyze_button.setEnabled(True)
+            self.stop_analysis_button.setEnabled(False)
 
+        if self.h264_done and self.h265_done and "H.264" in self.results and "H.265" in self.results:
             # Call plot_comparison_graph after displaying the results
             self.plot_comparison_graph()
 
@@ -771,7 +874,7 @@ class VideoPlayer(QWidget):
             self.h265_results_box.append(f"SSIM Score: {h265['ssim']:.10f}")
             self.h265_results_box.append(f"VMAF: {h265['vmaf']}")
 
-    def create_result_card(self, title, results_box=None, is_graph=False):
+    def create_result_card(self, title, results_box=None, is_graph=False, progress_bar=None):
         card = QGroupBox()  # Use QGroupBox to visually separate the sections
         card.setStyleSheet("QGroupBox { border: 2px solid #78B3CE; border-radius: 10px; padding: 10px; }")
 
@@ -794,6 +897,8 @@ class VideoPlayer(QWidget):
                 results_box.setReadOnly(True)
                 results_box.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
                 card_layout.addWidget(results_box)
+            if progress_bar:
+                card_layout.addWidget(progress_bar)
 
         card.setLayout(card_layout)
 